@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for roadster and route_nyc. Example usage:
+
+  python benchmarks.py                        # run the suite
+  python benchmarks.py --json new.json        # also save the results
+  python benchmarks.py --baseline base.json   # compare to saved results
+  python benchmarks.py --only pchip_2d        # only matching cases
+  python benchmarks.py --comparisons          # old against new versions
+
+The suite times each case a few times and reports the best wall time,
+evaluations per second and the peak memory allocated during one extra
+run under tracemalloc. Routes and tables are built before timing, so
+the results are for warm caches.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from scipy import interpolate
+import roadster
+import route_nyc
+from pchip_2d import pchip_2d
+
+def bench_batch(route="speed_anna.npz", n=1000):
+    """
+    Throughput of the array versions of distance and reach compared
+    to looping over the scalar versions.
+    """
+    r = roadster.get_route(route)
+    T = np.linspace(0.01, 1.0, n)
+    C = np.linspace(100, 20000, n)
+    for name, solve, targets in (("distance", r.distance, T), ("reach", r.reach, C)):
+        start = time.perf_counter()
+        scalar = np.array([solve(target) for target in targets])
+        scalar_time = time.perf_counter() - start
+        start = time.perf_counter()
+        batch = solve(targets)
+        batch_time = time.perf_counter() - start
+        print(f"{name}: {n} targets, scalar loop {n/scalar_time:10.0f}/s, "
+              f"batch {n/batch_time:10.0f}/s, max difference {np.max(np.abs(scalar - batch)):.1e} km")
+
+def _pchip_2d_loops(x,y,zz,xx_eval,yy_eval):
+    # pchip_2d verbatim as it was before vectorization, with a linear
+    # scan per point for the cell index and Python loops for the gathers
+    xx_eval = np.atleast_2d(xx_eval)
+    yy_eval = np.atleast_2d(yy_eval)
+    dx  = interpolate.pchip_interpolate(x, zz, x, der=1, axis=1)
+    dy  = interpolate.pchip_interpolate(y, zz, y, der=1, axis=0)
+    dxy = (interpolate.pchip_interpolate(x, dy, x, der=1, axis=1) +
+           interpolate.pchip_interpolate(y, dx, y, der=1, axis=0)) / 2
+    # Get xind
+    xind = np.zeros(xx_eval.shape, dtype='i')
+    for row in range(xx_eval.shape[0]):
+        for col in range(xx_eval.shape[1]):
+            ind = 0
+            while ind < x.size-2 and x[ind+1] <= xx_eval[row][col]:
+                ind = ind+1
+            xind[row][col] = ind
+    # Get yind
+    yind = np.zeros(yy_eval.shape, dtype='i')
+    for row in range(yy_eval.shape[0]):
+        for col in range(yy_eval.shape[1]):
+            ind = 0
+            while ind < y.size-2 and y[ind+1] <= yy_eval[row][col]:
+                ind = ind+1
+            yind[row][col] = ind
+    hx = x[1]-x[0]
+    hy = y[1]-y[0]
+    tx = (xx_eval - x[xind])/hx
+    ty = (yy_eval - y[yind])/hy
+    t2 = np.multiply(tx,tx)
+    t3 = np.multiply(tx,t2)
+    xb11 = 2*t3-3*t2+1
+    xb21 = hx*(t3-2*t2+tx)
+    xb12 = -2*t3+3*t2
+    xb22 = hx*(t3-t2)
+    t2 = np.multiply(ty,ty)
+    t3 = np.multiply(ty,t2)
+    yb11 = 2*t3-3*t2+1
+    yb21 = hy*(t3-2*t2+ty)
+    yb12 = -2*t3+3*t2
+    yb22 = hy*(t3-t2)
+
+    zz_eval = np.zeros(xx_eval.shape)
+    # i,j = 1,1
+    z_select   = np.zeros(yind.shape)
+    dx_select  = np.zeros(yind.shape)
+    dy_select  = np.zeros(yind.shape)
+    dxy_select = np.zeros(yind.shape)
+    for row in range(yind.shape[0]):
+        for col in range(yind.shape[1]):
+            z_select[row][col]   += zz[yind[row][col]][xind[row][col]]
+            dx_select[row][col]  += dx[yind[row][col]][xind[row][col]]
+            dy_select[row][col]  += dy[yind[row][col]][xind[row][col]]
+            dxy_select[row][col] += dxy[yind[row][col]][xind[row][col]]
+    zz_eval += np.multiply(np.multiply(xb11,yb11),z_select)
+    zz_eval += np.multiply(np.multiply(xb21,yb11),dx_select)
+    zz_eval += np.multiply(np.multiply(xb11,yb21),dy_select)
+    zz_eval += np.multiply(np.multiply(xb21,yb21),dxy_select)
+    # i,j = 1,2
+    z_select   = np.zeros(yind.shape)
+    dx_select  = np.zeros(yind.shape)
+    dy_select  = np.zeros(yind.shape)
+    dxy_select = np.zeros(yind.shape)
+    for row in range(yind.shape[0]):
+        for col in range(yind.shape[1]):
+            z_select[row][col]   += zz[yind[row][col]+1][xind[row][col]]
+            dx_select[row][col]  += dx[yind[row][col]+1][xind[row][col]]
+            dy_select[row][col]  += dy[yind[row][col]+1][xind[row][col]]
+            dxy_select[row][col] += dxy[yind[row][col]+1][xind[row][col]]
+    zz_eval += np.multiply(np.multiply(xb11,yb12),z_select)
+    zz_eval += np.multiply(np.multiply(xb21,yb12),dx_select)
+    zz_eval += np.multiply(np.multiply(xb11,yb22),dy_select)
+    zz_eval += np.multiply(np.multiply(xb21,yb22),dxy_select)
+    # i,j = 2,1
+    z_select   = np.zeros(yind.shape)
+    dx_select  = np.zeros(yind.shape)
+    dy_select  = np.zeros(yind.shape)
+    dxy_select = np.zeros(yind.shape)
+    for row in range(yind.shape[0]):
+        for col in range(yind.shape[1]):
+            z_select[row][col]   += zz[yind[row][col]][xind[row][col]+1]
+            dx_select[row][col]  += dx[yind[row][col]][xind[row][col]+1]
+            dy_select[row][col]  += dy[yind[row][col]][xind[row][col]+1]
+            dxy_select[row][col] += dxy[yind[row][col]][xind[row][col]+1]
+    zz_eval += np.multiply(np.multiply(xb12,yb11),z_select)
+    zz_eval += np.multiply(np.multiply(xb22,yb11),dx_select)
+    zz_eval += np.multiply(np.multiply(xb12,yb21),dy_select)
+    zz_eval += np.multiply(np.multiply(xb22,yb21),dxy_select)
+    # i,j = 2,2
+    z_select   = np.zeros(yind.shape)
+    dx_select  = np.zeros(yind.shape)
+    dy_select  = np.zeros(yind.shape)
+    dxy_select = np.zeros(yind.shape)
+    for row in range(yind.shape[0]):
+        for col in range(yind.shape[1]):
+            z_select[row][col]   += zz[yind[row][col]+1][xind[row][col]+1]
+            dx_select[row][col]  += dx[yind[row][col]+1][xind[row][col]+1]
+            dy_select[row][col]  += dy[yind[row][col]+1][xind[row][col]+1]
+            dxy_select[row][col] += dxy[yind[row][col]+1][xind[row][col]+1]
+    zz_eval += np.multiply(np.multiply(xb12,yb12),z_select)
+    zz_eval += np.multiply(np.multiply(xb22,yb12),dx_select)
+    zz_eval += np.multiply(np.multiply(xb12,yb22),dy_select)
+    zz_eval += np.multiply(np.multiply(xb22,yb22),dxy_select)
+    return zz_eval
+
+def bench_pchip_2d(sizes=(10**2, 10**4, 10**6)):
+    """
+    Vectorized pchip_2d compared to the loop implementation it
+    replaced, on square grids of evaluation points over the NYC data.
+    """
+    for size in sizes:
+        n = int(np.sqrt(size))
+        tt, xx = np.meshgrid(np.linspace(0, 24, n), np.linspace(0, 60, n))
+        start = time.perf_counter()
+        loops = _pchip_2d_loops(route_nyc.data_t, route_nyc.data_x, route_nyc.nyc_velocity, tt, xx)
+        loops_time = time.perf_counter() - start
+        start = time.perf_counter()
+        vectorized = pchip_2d(route_nyc.data_t, route_nyc.data_x, route_nyc.nyc_velocity, tt, xx)
+        vectorized_time = time.perf_counter() - start
+        print(f"pchip_2d: {n*n:8d} points, loops {loops_time:9.4f} s, "
+              f"vectorized {vectorized_time:9.4f} s, speedup {loops_time/vectorized_time:7.1f}, "
+              f"max difference {np.max(np.abs(loops - vectorized)):.1e}")
+
+def bench_route_nyc_scalar(n=10000):
+    """
+    Per call overhead of route_nyc(t, x)[0][0], as the Euler traveler
+    used to call it, against route_nyc_scalar(t, x).
+    """
+    rng = np.random.default_rng(0)
+    points = list(zip(rng.uniform(0, 24, n).tolist(), rng.uniform(0, 60, n).tolist()))
+    for name, evaluate in (("route_nyc(t, x)[0][0]", lambda t, x: route_nyc.route_nyc(t, x)[0][0]),
+                           ("route_nyc_scalar(t, x)", route_nyc.route_nyc_scalar)):
+        start = time.perf_counter()
+        for t, x in points:
+            evaluate(t, x)
+        print(f"{name:24s} {(time.perf_counter() - start)/n*1e6:8.2f} us per call")
+
+def bench_nyc_traveler_methods(t0=8):
+    """
+    Steps, time and arrival time error of the NYC route integrators,
+    against a Dormand-Prince solution with tolerance 1e-12 km.
+    """
+    reference = route_nyc.nyc_route_traveler(t0, 0.1, 'dopri5', 1e-12)[0][-1]
+    runs = [('euler', h, None) for h in (0.1, 0.01, 0.001)]
+    runs += [('heun', h, None) for h in (0.1, 0.01, 0.001)]
+    runs += [('rk4', h, None) for h in (0.1, 0.01, 0.001)]
+    runs += [('dopri5', 0.1, tol) for tol in (1e-4, 1e-6, 1e-8)]
+    for method, h, tol in runs:
+        start = time.perf_counter()
+        time_h, _, _ = route_nyc.nyc_route_traveler(t0, h, method, tol)
+        elapsed = time.perf_counter() - start
+        setting = f"tol={tol:g}" if tol is not None else f"h={h:g}"
+        print(f"{method:6s} {setting:10s} {time_h.size - 1:6d} steps {elapsed:8.4f} s, "
+              f"arrival error {abs(time_h[-1] - reference):.1e} h")
+
+def bench_evaluate_routes(n_routes=400, max_workers=None):
+    """
+    Scaling of evaluate_routes with the number of worker processes, on
+    a store of n_routes perturbed copies of the sample routes.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        store = os.path.join(directory, "fleet")
+        names = []
+        for i in range(n_routes):
+            distance_km, speed_kmph = roadster.load_route(("speed_anna.npz", "speed_elsa.npz")[i % 2])
+            speed_kmph = speed_kmph * rng.uniform(0.8, 1.2)
+            names.append(f"route{i}")
+            roadster.save_route(names[-1], distance_km, speed_kmph, store=store)
+        max_workers = max_workers or os.cpu_count()
+        workers = 1
+        while True:
+            start = time.perf_counter()
+            roadster.evaluate_routes(names, T=0.5, C=10000, store=store, workers=workers)
+            elapsed = time.perf_counter() - start
+            if workers == 1:
+                serial = elapsed
+            print(f"evaluate_routes: {n_routes} routes, {workers:3d} workers {elapsed:8.3f} s, "
+                  f"{n_routes/elapsed:8.1f} routes/s, speedup {serial/elapsed:5.2f}")
+            if workers >= max_workers:
+                break
+            workers = min(2*workers, max_workers)
+
+def measure(run, evaluations, min_time=0.2, max_repeat=10):
+    """
+    Best wall time of run() over repeats until min_time has passed,
+    evaluations per second at that time, and the peak memory (bytes)
+    traced during a first, untimed run.
+    """
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = float('inf')
+    total = 0.0
+    for _ in range(max_repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        if total >= min_time:
+            break
+    return {'wall_s': best, 'evals_per_s': evaluations/best, 'peak_bytes': peak}
+
+def cases(route="speed_anna.npz"):
+    """
+    (name, size, evaluations, run) for every benchmark case. size is the
+    problem size the case is known by, evaluations the number of results
+    or integrand points it computes.
+    """
+    length = roadster.get_route(route).length
+    for n in (10**3, 10**5, 10**7):
+        x = np.linspace(0, length, n)
+        yield "velocity", n, n, lambda x=x: roadster.velocity(x, route)
+    for n in (10**3, 10**5, 10**7):
+        yield ("time_to_destination", n, n,
+               lambda n=n: roadster.time_to_destination(length, route, n))
+        yield ("total_consumption", n, n,
+               lambda n=n: roadster.total_consumption(length, route, n))
+    for n in (1, 10**2, 10**4):
+        T = 0.5 if n == 1 else np.linspace(0.01, 1.0, n)
+        C = 10000 if n == 1 else np.linspace(100, 20000, n)
+        yield "distance", n, n, lambda T=T: roadster.distance(T, route)
+        yield "reach", n, n, lambda C=C: roadster.reach(C, route)
+    for n in (10**2, 10**4, 10**6):
+        side = int(np.sqrt(n))
+        tt, xx = np.meshgrid(np.linspace(0, 24, side), np.linspace(0, 60, side))
+        yield ("pchip_2d", n, side*side,
+               lambda tt=tt, xx=xx: pchip_2d(route_nyc.data_t, route_nyc.data_x,
+                                             route_nyc.nyc_velocity, tt, xx))
+        yield "route_nyc", n, side*side, lambda tt=tt, xx=xx: route_nyc.route_nyc(tt, xx)
+    for h in (1e-2, 1e-3, 1e-4):
+        steps = len(route_nyc.nyc_route_traveler_euler(8, h)[0]) - 1
+        yield ("nyc_route_traveler_euler", h, steps,
+               lambda h=h: route_nyc.nyc_route_traveler_euler(8, h))
+
+def run_suite(only=None):
+    """Results of all cases whose name contains only, as a list of dicts."""
+    results = []
+    for name, size, evaluations, run in cases():
+        if only is not None and only not in name:
+            continue
+        result = {'name': name, 'size': size, **measure(run, evaluations)}
+        print(f"{name:26s} {size:>9g} {result['wall_s']:10.5f} s "
+              f"{result['evals_per_s']:12.4g}/s {result['peak_bytes']/2**20:9.2f} MiB")
+        results.append(result)
+    return results
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Print the wall time of each result relative to the baseline result
+    of the same name and size. Returns the cases more than threshold
+    (a fraction) slower than the baseline.
+    """
+    previous = {(b['name'], b['size']): b for b in baseline['results']}
+    regressions = []
+    for result in results:
+        b = previous.get((result['name'], result['size']))
+        if b is None:
+            continue
+        ratio = result['wall_s'] / b['wall_s']
+        memory = result['peak_bytes'] / max(b['peak_bytes'], 1)
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(result)
+        print(f"{result['name']:26s} {result['size']:>9g} time x{ratio:6.2f} "
+              f"memory x{memory:6.2f}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for roadster and route_nyc")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --json")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="slowdown counted as a regression (default 0.25)")
+    parser.add_argument("--only", help="only run cases whose name contains this")
+    parser.add_argument("--comparisons", action="store_true",
+                        help="run the comparisons of old and new implementations")
+    args = parser.parse_args(argv)
+    if args.comparisons:
+        bench_batch()
+        bench_pchip_2d()
+        bench_route_nyc_scalar()
+        bench_nyc_traveler_methods()
+        bench_evaluate_routes()
+        return 0
+    results = run_suite(args.only)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'roadster': roadster.__version__, 'machine': platform.machine(),
+                       'results': results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+class Recorder:
+    """
+    Counts and stage timings collected while recording, see record().
+    counts[name] is the sum of all n passed to count(name, n) and
+    calls[name] the number of such calls, so for 'velocity' they are
+    the number of points and the number of calls. For
+    'newton_iterations' counts is the number of iterations summed over
+    all solved elements, whether scalar or batched, and calls is one
+    per scalar solve and one per round of a batch solve. seconds[name]
+    is the total time spent in stage(name), entered stages[name] times.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.calls = {}
+        self.seconds = {}
+        self.stages = {}
+
+    def to_dict(self):
+        return {'counts': dict(self.counts), 'calls': dict(self.calls),
+                'stages': {name: {'calls': self.stages[name], 'seconds': self.seconds[name]}
+                           for name in self.stages}}
+
+# The active Recorder, or None when nothing is recorded
+_recorder = None
+_NOT_RECORDING = nullcontext()
+
+@contextmanager
+def record():
+    """
+    Record counts and stage times of everything run in the block.
+    Example usage:
+
+      with instrumentation.record() as recorder:
+          roadster.reach(10000, 'speed_anna')
+      recorder.to_dict()['counts']['newton_iterations']
+
+    Recording blocks can be nested, only the innermost one records.
+    """
+    global _recorder
+    previous = _recorder
+    _recorder = recorder = Recorder()
+    try:
+        yield recorder
+    finally:
+        _recorder = previous
+
+def recording():
+    return _recorder is not None
+
+def count(name, n=1):
+    """Add n to the count of name, if recording. Otherwise a no-op."""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.counts[name] = recorder.counts.get(name, 0) + n
+        recorder.calls[name] = recorder.calls.get(name, 0) + 1
+
+class _Stage:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        recorder, name = self.recorder, self.name
+        recorder.seconds[name] = recorder.seconds.get(name, 0.0) + elapsed
+        recorder.stages[name] = recorder.stages.get(name, 0) + 1
+
+def stage(name):
+    """
+    Context manager timing the block as the named stage, if recording.
+    Example usage:
+
+      with instrumentation.stage('load_route'):
+          data = np.load(route)
+
+    When not recording, a shared do-nothing context manager is returned.
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NOT_RECORDING
+    return _Stage(recorder, name)
@@ -4,12 +4,14 @@ import numpy as np
 
 route = "roadster/speed_anna.npz"
 
-n = 16*np.array([(2**i) for i in range(22)])
-
 x, raw_v = roadster.load_route(route)
 
-T = lambda n: roadster.time_to_destination(x[-1], route, n)
-c2h2 = [np.abs(T((2*i) + 1) - T(i + 1))/3 for i in n]
+# 16, 32, ..., 16*2**22 intervals on nested grids, each level only
+# evaluates the new midpoints. |T(2n) - T(n)|/3 is plotted against the
+# coarser n = 16, ..., 16*2**21.
+study = roadster.convergence_study(x[-1], route, n0=16, levels=23)
+n = study['n'][:-1]
+c2h2 = study['error'][1:]
 
 fig_v, ax_v = plt.subplots()
 fig_v.suptitle('Error för olika n')
@@ -1,6 +1,21 @@
 from scipy import interpolate
 import numpy as np 
 
+import instrumentation
+
+def _derivatives(x, y, zz):
+    # pchip estimates of dz/dx, dz/dy and d2z/dxdy at the data points
+    dx  = interpolate.pchip_interpolate(x, zz, x, der=1, axis=1)
+    dy  = interpolate.pchip_interpolate(y, zz, y, der=1, axis=0)
+    dxy = (interpolate.pchip_interpolate(x, dy, x, der=1, axis=1) +
+           interpolate.pchip_interpolate(y, dx, y, der=1, axis=0)) / 2
+    return dx, dy, dxy
+
+def _cell_index(x, xx_eval):
+    # Index of the cell containing each point, points outside the grid
+    # use the first or last cell
+    return np.clip(np.searchsorted(x, xx_eval, side='right') - 1, 0, x.size-2)
+
 def pchip_2d(x,y,zz,xx_eval,yy_eval):
     """
     Two-dimensional pchip interpolation
@@ -17,26 +32,9 @@ def pchip_2d(x,y,zz,xx_eval,yy_eval):
     """
     xx_eval = np.atleast_2d(xx_eval)
     yy_eval = np.atleast_2d(yy_eval)
-    dx  = interpolate.pchip_interpolate(x, zz, x, der=1, axis=1)
-    dy  = interpolate.pchip_interpolate(y, zz, y, der=1, axis=0)
-    dxy = (interpolate.pchip_interpolate(x, dy, x, der=1, axis=1) +
-           interpolate.pchip_interpolate(y, dx, y, der=1, axis=0)) / 2
-    # Get xind
-    xind = np.zeros(xx_eval.shape, dtype='i')
-    for row in range(xx_eval.shape[0]):
-        for col in range(xx_eval.shape[1]):
-            ind = 0
-            while ind < x.size-2 and x[ind+1] <= xx_eval[row][col]:
-                ind = ind+1
-            xind[row][col] = ind
-    # Get yind
-    yind = np.zeros(yy_eval.shape, dtype='i')
-    for row in range(yy_eval.shape[0]):
-        for col in range(yy_eval.shape[1]):
-            ind = 0
-            while ind < y.size-2 and y[ind+1] <= yy_eval[row][col]:
-                ind = ind+1
-            yind[row][col] = ind
+    dx, dy, dxy = _derivatives(x, y, zz)
+    xind = _cell_index(x, xx_eval)
+    yind = _cell_index(y, yy_eval)
     hx = x[1]-x[0]
     hy = y[1]-y[0]
     tx = (xx_eval - x[xind])/hx
@@ -55,64 +53,93 @@ def pchip_2d(x,y,zz,xx_eval,yy_eval):
     yb22 = hy*(t3-t2)
 
     zz_eval = np.zeros(xx_eval.shape)
-    # i,j = 1,1
-    z_select   = np.zeros(yind.shape)
-    dx_select  = np.zeros(yind.shape)
-    dy_select  = np.zeros(yind.shape)
-    dxy_select = np.zeros(yind.shape)
-    for row in range(yind.shape[0]):
-        for col in range(yind.shape[1]):
-            z_select[row][col]   += zz[yind[row][col]][xind[row][col]]
-            dx_select[row][col]  += dx[yind[row][col]][xind[row][col]]
-            dy_select[row][col]  += dy[yind[row][col]][xind[row][col]]
-            dxy_select[row][col] += dxy[yind[row][col]][xind[row][col]]
-    zz_eval += np.multiply(np.multiply(xb11,yb11),z_select)
-    zz_eval += np.multiply(np.multiply(xb21,yb11),dx_select)
-    zz_eval += np.multiply(np.multiply(xb11,yb21),dy_select)
-    zz_eval += np.multiply(np.multiply(xb21,yb21),dxy_select)
-    # i,j = 1,2
-    z_select   = np.zeros(yind.shape)
-    dx_select  = np.zeros(yind.shape)
-    dy_select  = np.zeros(yind.shape)
-    dxy_select = np.zeros(yind.shape)
-    for row in range(yind.shape[0]):
-        for col in range(yind.shape[1]):
-            z_select[row][col]   += zz[yind[row][col]+1][xind[row][col]]
-            dx_select[row][col]  += dx[yind[row][col]+1][xind[row][col]]
-            dy_select[row][col]  += dy[yind[row][col]+1][xind[row][col]]
-            dxy_select[row][col] += dxy[yind[row][col]+1][xind[row][col]]
-    zz_eval += np.multiply(np.multiply(xb11,yb12),z_select)
-    zz_eval += np.multiply(np.multiply(xb21,yb12),dx_select)
-    zz_eval += np.multiply(np.multiply(xb11,yb22),dy_select)
-    zz_eval += np.multiply(np.multiply(xb21,yb22),dxy_select)
-    # i,j = 2,1
-    z_select   = np.zeros(yind.shape)
-    dx_select  = np.zeros(yind.shape)
-    dy_select  = np.zeros(yind.shape)
-    dxy_select = np.zeros(yind.shape)
-    for row in range(yind.shape[0]):
-        for col in range(yind.shape[1]):
-            z_select[row][col]   += zz[yind[row][col]][xind[row][col]+1]
-            dx_select[row][col]  += dx[yind[row][col]][xind[row][col]+1]
-            dy_select[row][col]  += dy[yind[row][col]][xind[row][col]+1]
-            dxy_select[row][col] += dxy[yind[row][col]][xind[row][col]+1]
-    zz_eval += np.multiply(np.multiply(xb12,yb11),z_select)
-    zz_eval += np.multiply(np.multiply(xb22,yb11),dx_select)
-    zz_eval += np.multiply(np.multiply(xb12,yb21),dy_select)
-    zz_eval += np.multiply(np.multiply(xb22,yb21),dxy_select)
-    # i,j = 2,2
-    z_select   = np.zeros(yind.shape)
-    dx_select  = np.zeros(yind.shape)
-    dy_select  = np.zeros(yind.shape)
-    dxy_select = np.zeros(yind.shape)
-    for row in range(yind.shape[0]):
-        for col in range(yind.shape[1]):
-            z_select[row][col]   += zz[yind[row][col]+1][xind[row][col]+1]
-            dx_select[row][col]  += dx[yind[row][col]+1][xind[row][col]+1]
-            dy_select[row][col]  += dy[yind[row][col]+1][xind[row][col]+1]
-            dxy_select[row][col] += dxy[yind[row][col]+1][xind[row][col]+1]
-    zz_eval += np.multiply(np.multiply(xb12,yb12),z_select)
-    zz_eval += np.multiply(np.multiply(xb22,yb12),dx_select)
-    zz_eval += np.multiply(np.multiply(xb12,yb22),dy_select)
-    zz_eval += np.multiply(np.multiply(xb22,yb22),dxy_select)
+    for xb1, xb2, xi in ((xb11, xb21, xind), (xb12, xb22, xind+1)):
+        for yb1, yb2, yi in ((yb11, yb21, yind), (yb12, yb22, yind+1)):
+            zz_eval += np.multiply(np.multiply(xb1,yb1),zz[yi,xi])
+            zz_eval += np.multiply(np.multiply(xb2,yb1),dx[yi,xi])
+            zz_eval += np.multiply(np.multiply(xb1,yb2),dy[yi,xi])
+            zz_eval += np.multiply(np.multiply(xb2,yb2),dxy[yi,xi])
     return zz_eval
+
+# Coefficients of the cubic Hermite basis functions in t = (x - x0)/h,
+# for the value at t = 0, the value at t = 1, and the derivatives at
+# t = 0 and t = 1 (to be multiplied by h)
+_HERMITE = np.array([[1, 0, -3,  2],
+                     [0, 0,  3, -2],
+                     [0, 1, -2,  1],
+                     [0, 0, -1,  1]], dtype=float)
+
+class Pchip2D:
+    """
+    Two-dimensional pchip interpolant with the bicubic polynomial of
+    every grid cell computed once. Example usage:
+
+      f = Pchip2D(x, y, zz)
+      zz_eval = f(xx_eval, yy_eval)
+
+    Gives the same values as pchip_2d(x, y, zz, xx_eval, yy_eval), up
+    to rounding, see pchip_2d for the parameters. Evaluation is a cell
+    lookup followed by a 4x4 polynomial in the local coordinates.
+    """
+    def __init__(self, x, y, zz):
+        instrumentation.count('pchip_2d_build')
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        zz = np.asarray(zz, dtype=float)
+        self.hx = self.x[1]-self.x[0]
+        self.hy = self.y[1]-self.y[0]
+        dx, dy, dxy = _derivatives(self.x, self.y, zz)
+        # Hermite data of each cell, G[j, i, a, b] with a the basis
+        # function in x and b the basis function in y
+        ny, nx = zz.shape
+        data = {(False, False): zz, (True, False): dx,
+                (False, True): dy, (True, True): dxy}
+        G = np.empty((ny-1, nx-1, 4, 4))
+        for a in range(4):
+            for b in range(4):
+                G[:, :, a, b] = data[a >= 2, b >= 2][b%2:ny-1+b%2, a%2:nx-1+a%2]
+        ax = _HERMITE * np.array([[1], [1], [self.hx], [self.hx]])
+        ay = _HERMITE * np.array([[1], [1], [self.hy], [self.hy]])
+        # coefficients[j, i, p, q] multiplies tx**p * ty**q
+        self.coefficients = np.einsum('ap,jiab,bq->jipq', ax, G, ay)
+        # Python lists of the coefficients and nodes, and the steps as
+        # Python floats, made for scalar()
+        self._cells = None
+        self._nodes = None
+
+    def __call__(self, xx_eval, yy_eval):
+        xx_eval = np.atleast_2d(xx_eval)
+        yy_eval = np.atleast_2d(yy_eval)
+        xind = _cell_index(self.x, xx_eval)
+        yind = _cell_index(self.y, yy_eval)
+        tx = (xx_eval - self.x[xind])/self.hx
+        ty = (yy_eval - self.y[yind])/self.hy
+        c = self.coefficients[yind, xind]
+        zz_eval = 0
+        for p in range(3, -1, -1):
+            zz_eval = zz_eval*tx + (((c[..., p, 3]*ty + c[..., p, 2])*ty
+                                      + c[..., p, 1])*ty + c[..., p, 0])
+        return zz_eval
+
+    def scalar(self, x, y):
+        """
+        Value at the single point (x, y), using plain Python floats
+        throughout so no NumPy arrays are created. Meant for step by step
+        integrators calling the interpolant once per step.
+        """
+        if self._cells is None:
+            self._cells = self.coefficients.tolist()
+            self._nodes = (self.x.tolist(), self.y.tolist(),
+                           float(self.hx), float(self.hy))
+        x_nodes, y_nodes, hx, hy = self._nodes
+        # Closed form cell index on the equally spaced grid
+        i = min(max(int((x - x_nodes[0])/hx), 0), len(x_nodes)-2)
+        j = min(max(int((y - y_nodes[0])/hy), 0), len(y_nodes)-2)
+        tx = (x - x_nodes[i])/hx
+        ty = (y - y_nodes[j])/hy
+        c = self._cells[j][i]
+        z = 0.0
+        for p in (3, 2, 1, 0):
+            cp = c[p]
+            z = z*tx + (((cp[3]*ty + cp[2])*ty + cp[1])*ty + cp[0])
+        return z
@@ -0,0 +1,223 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+@lru_cache(maxsize=None)
+def _leggauss(n):
+    return np.polynomial.legendre.leggauss(n)
+
+def gauss_legendre(f, a, b, n=8):
+    """
+    n-point Gauss-Legendre quadrature of f over [a, b]. Example usage:
+
+      gauss_legendre(np.sin, 0, np.pi)
+      gauss_legendre(np.sin, np.array([0, 1]), np.array([1, 2]))
+
+    a and b may be arrays of interval endpoints, and one integral is
+    returned per interval. f is called once, with an array of shape
+    a.shape + (n,) holding the nodes of all intervals. The rule is
+    exact for polynomials of degree 2n-1.
+    """
+    nodes, weights = _leggauss(n)
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    half = (b - a) / 2
+    mid = (b + a) / 2
+    fx = f(mid[..., None] + half[..., None] * nodes)
+    return half * (fx @ weights)
+
+def trapezoid(f, a, b, N, chunk_size=65536, buffered=False):
+    """
+    Trapezoidal rule for f over [a, b] with N equally spaced points.
+    Example usage:
+
+      trapezoid(np.sin, 0, np.pi, 10000001)
+      trapezoid(lambda x, out: np.sin(x, out=out), 0, np.pi, 10000001,
+                buffered=True)
+
+    f is evaluated on blocks of at most chunk_size points at a time, so
+    memory use does not grow with N. The block sums are added with
+    compensated (Neumaier) summation. With buffered=True, f is called as
+    f(x, out) and must write its values into out and return it; the
+    points and the values of every block then reuse the same two arrays.
+    """
+    h = (b - a) / (N - 1)
+    total = 0.0
+    compensation = 0.0
+    if buffered:
+        steps = np.arange(min(chunk_size, N), dtype=float)
+        x_buffer = np.empty_like(steps)
+        fx_buffer = np.empty_like(steps)
+    for start in range(0, N, chunk_size):
+        stop = min(start + chunk_size, N)
+        if buffered:
+            x = x_buffer[:stop - start]
+            np.add(steps[:stop - start], start, out=x)
+            x *= h
+            x += a
+        else:
+            x = a + h * np.arange(start, stop)
+        if stop == N:
+            x[-1] = b
+        fx = f(x, fx_buffer[:stop - start]) if buffered else f(x)
+        s = np.sum(fx)
+        if start == 0:
+            s -= fx[0] / 2
+        if stop == N:
+            s -= fx[-1] / 2
+        t = total + s
+        if abs(total) >= abs(s):
+            compensation += (total - t) + s
+        else:
+            compensation += (s - t) + total
+        total = t
+    return h * (total + compensation)
+
+# 15-point Kronrod rule and the embedded 7-point Gauss rule on [-1, 1]
+_KRONROD_NODES = np.array([
+    -0.991455371120812639206854697526329, -0.949107912342758524526189684047851,
+    -0.864864423359769072789712788640926, -0.741531185599394439863864773280788,
+    -0.586087235467691130294144845693013, -0.405845151377397166906606412076961,
+    -0.207784955007898467600689403773245, 0.0,
+    0.207784955007898467600689403773245, 0.405845151377397166906606412076961,
+    0.586087235467691130294144845693013, 0.741531185599394439863864773280788,
+    0.864864423359769072789712788640926, 0.949107912342758524526189684047851,
+    0.991455371120812639206854697526329])
+_KRONROD_WEIGHTS = np.array([
+    0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+    0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+    0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+    0.204432940075298892414161999234649, 0.209482141084727828012999174891714,
+    0.204432940075298892414161999234649, 0.190350578064785409913256402421014,
+    0.169004726639267902826583426598550, 0.140653259715525918745189590510238,
+    0.104790010322250183839876322541518, 0.063092092629978553290700663189204,
+    0.022935322010529224963732008058970])
+# Weights of the Gauss nodes, which are every other Kronrod node
+_GAUSS_WEIGHTS = np.array([
+    0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+    0.381830050505118944950369775488975, 0.417959183673469387755102040816327,
+    0.381830050505118944950369775488975, 0.279705391489276667901467771423780,
+    0.129484966168869693270611432679082])
+
+def gauss_kronrod(f, a, b, tol, max_intervals=100000):
+    """
+    Adaptive 15-point Gauss-Kronrod quadrature of f over [a, b].
+    Example usage:
+
+      value, error, evaluations = gauss_kronrod(np.sqrt, 0, 1, 1e-10)
+
+    Intervals are bisected until the difference between the Kronrod
+    and Gauss results, which is used as error estimate, is at most tol
+    times the interval's share of [a, b]. Only intervals that have not
+    converged are refined, and all of them are evaluated with one call
+    of f per round. Returns the integral, the estimated error and the
+    number of evaluations of f. If more than max_intervals intervals
+    would be needed, the current ones are accepted as they are.
+    """
+    lo = np.array([a], dtype=float)
+    hi = np.array([b], dtype=float)
+    width = abs(b - a)
+    value = 0.0
+    error = 0.0
+    evaluations = 0
+    while lo.size:
+        half = (hi - lo) / 2
+        mid = (hi + lo) / 2
+        fx = f(mid[:, None] + half[:, None] * _KRONROD_NODES)
+        evaluations += fx.size
+        kronrod = half * (fx @ _KRONROD_WEIGHTS)
+        interval_error = np.abs(kronrod - half * (fx[:, 1::2] @ _GAUSS_WEIGHTS))
+        done = interval_error <= tol * np.abs(hi - lo) / width if width > 0 else True
+        if 2 * np.count_nonzero(~done) > max_intervals:
+            done = True
+        done = np.broadcast_to(done, lo.shape)
+        value += np.sum(kronrod[done])
+        error += np.sum(interval_error[done])
+        lo, mid, hi = lo[~done], mid[~done], hi[~done]
+        lo, hi = np.concatenate((lo, mid)), np.concatenate((mid, hi))
+    return value, error, evaluations
+
+def _midpoint_sum(f, a, h, n, chunk_size):
+    # Sum of f at a + (i + 1/2) h for i < n, chunk_size points at a time
+    return math.fsum(np.sum(f(a + h * (np.arange(start, min(start + chunk_size, n)) + 0.5)))
+                     for start in range(0, n, chunk_size))
+
+def nested_trapezoid(f, a, b, n0=1, chunk_size=65536):
+    """
+    Trapezoidal approximations of the integral of f over [a, b] with
+    n0, 2 n0, 4 n0, ... intervals. Example usage:
+
+      for n, value, evaluations in nested_trapezoid(np.sin, 0, np.pi):
+          if n >= 1024:
+              break
+
+    Each level halves the step, so its grid contains the previous one
+    and f only needs to be evaluated at the new midpoints. Yields the
+    number of intervals, the trapezoid value and the total number of
+    evaluations of f so far.
+    """
+    h = (b - a) / n0
+    n = n0
+    value = trapezoid(f, a, b, n0 + 1, chunk_size)
+    evaluations = n0 + 1
+    while True:
+        yield n, value, evaluations
+        value = value / 2 + h / 2 * _midpoint_sum(f, a, h, n, chunk_size)
+        evaluations += n
+        n *= 2
+        h /= 2
+
+def romberg(f, a, b, tol, n0=1, max_levels=25, chunk_size=65536):
+    """
+    Romberg integration of f over [a, b]: Richardson extrapolation of
+    the nested trapezoid values from nested_trapezoid. Example usage:
+
+      value, error, evaluations = romberg(np.sin, 0, np.pi, 1e-12)
+
+    Refinement stops when the last two extrapolated values differ by at
+    most tol, or after max_levels grids. Returns the extrapolated
+    value, that difference as error estimate and the number of
+    evaluations of f.
+    """
+    previous_row = []
+    for level, (n, value, evaluations) in enumerate(nested_trapezoid(f, a, b, n0, chunk_size)):
+        row = [value]
+        for k, previous in enumerate(previous_row):
+            row.append(row[k] + (row[k] - previous) / (4**(k + 1) - 1))
+        if previous_row:
+            error = abs(row[-1] - previous_row[-1])
+            if error <= tol or level + 1 >= max_levels:
+                return row[-1], error, evaluations
+        previous_row = row
+
+def convergence_study(f, a, b, n0=1, levels=20, chunk_size=65536):
+    """
+    Convergence of the trapezoidal rule for f over [a, b] on the nested
+    grids of nested_trapezoid with n0, 2 n0, ..., 2**(levels-1) n0
+    intervals. Example usage:
+
+      study = convergence_study(np.sin, 0, np.pi, n0=16, levels=10)
+      study['order'][-1]   # close to 2
+
+    Returns a dict of arrays with one entry per level: 'n' intervals,
+    'value' the trapezoid value, 'error' the estimate |T(n) - T(n/2)|/3
+    of its error, 'order' the observed order log2 of the ratio of
+    successive error estimates, and 'evaluations' of f so far. The
+    first level has no error estimate and the first two no order, they
+    are nan. f is evaluated once per grid point of the finest level in
+    all, chunk_size points at a time.
+    """
+    rows = []
+    for row in nested_trapezoid(f, a, b, n0, chunk_size):
+        rows.append(row)
+        if len(rows) == levels:
+            break
+    n, value, evaluations = (np.array(column) for column in zip(*rows))
+    error = np.full(levels, np.nan)
+    error[1:] = np.abs(np.diff(value)) / 3
+    order = np.full(levels, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        order[2:] = np.log2(error[1:-1] / error[2:])
+    return {'n': n, 'value': value, 'error': error, 'order': order,
+            'evaluations': evaluations}
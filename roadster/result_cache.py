@@ -0,0 +1,121 @@
+import hashlib
+import os
+
+import numpy as np
+
+class ResultCache:
+    """
+    Results of expensive solves stored on disk, one .npy file per
+    result, named by a hash of everything the result depends on.
+    Example usage:
+
+      cache = ResultCache('.roadster_cache', max_bytes=2**28)
+      key = cache.key('distance', route_digest, T, version)
+      value = cache.get(key)
+      if value is None:
+          value = solve(T)
+          cache.put(key, value)
+
+    The key is a sha256 hash, so an entry is found again only if all
+    of its inputs are equal. When a route changes its hash changes, the
+    old entries are never hit again and are evicted in time. Each hit
+    touches the modification time of its file. When the directory
+    grows beyond max_bytes the least recently used files are removed
+    until it is at most three quarters of max_bytes. The size of the
+    directory is counted once when the cache is opened and then kept up
+    to date by put, so only a put that goes over max_bytes scans the
+    directory. Files are written under a temporary name and then
+    renamed, so several processes can share one cache directory.
+    """
+    def __init__(self, directory, max_bytes=2**28):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        # Bytes in the directory, kept up to date by put so that the
+        # directory is only scanned again when it is over budget
+        self._total = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(*parts):
+        """Hex digest of the parts, which may be strings, numbers or arrays."""
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                data = part.encode()
+            else:
+                part = np.ascontiguousarray(part)
+                data = f"{part.dtype.str}{part.shape}".encode() + part.tobytes()
+            # Length prefixes keep the boundaries between parts unambiguous
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, key):
+        """The stored result for key, or None if there is none."""
+        path = self._path(key)
+        try:
+            value = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # Missing, or removed or cut short by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value[()] if value.ndim == 0 else value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(value))
+            size = f.tell()
+        try:
+            # The result replaces an existing file with the same key
+            self._total -= os.stat(path).st_size
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        self._total += size
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        # (mtime, size, path) of every stored result
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        # Rescan, since other processes may share the directory, then
+        # remove the least recently used results. Going well below the
+        # budget leaves room for many puts before the next scan.
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes*3//4:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total = total
+
+    def clear(self):
+        """Remove all stored results."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.directory, name))
+        self._total = 0
@@ -1,7 +1,20 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from scipy import interpolate
 
-def load_route(route):
+import instrumentation
+import rootfinding
+from quadrature import gauss_kronrod, gauss_legendre, romberg, trapezoid
+from quadrature import convergence_study as quadrature_convergence_study
+from result_cache import ResultCache
+from route_store import RouteStore
+
+__version__ = '1.1.0'
+
+def load_route(route, store=None):
     """
     Get speed data from route .npz-file. Example usage:
 
@@ -11,29 +24,380 @@ def load_route(route):
     speed_kmph, of equal length with position (in km) and speed
     (in km/h) along route. Those two arrays are returned by this
     convenience function.
+
+    With store, a RouteStore or the path of one, the named route is
+    read from the store instead, as memory-mapped arrays.
     """
+    instrumentation.count('load_route')
+    if store is not None:
+        return _open_store(store).load(route)
     # Read data from npz file
-    if not route.endswith(".npz"):
-        route = f"{route}.npz"
-    data = np.load(route)
-    distance_km = data["distance_km"]
-    speed_kmph = data["speed_kmph"]
+    route = _route_path(route)
+    with instrumentation.stage('load_route'):
+        data = np.load(route)
+        distance_km = data["distance_km"]
+        speed_kmph = data["speed_kmph"]
     return distance_km, speed_kmph
 
-def save_route(route, distance_km, speed_kmph):
+def save_route(route, distance_km, speed_kmph, store=None):
     """
     Write speed data to route file. Example usage:
 
       save_route('speed_olof.npz', distance_km, speed_kmph)
+      save_route('olof', distance_km, speed_kmph, store='fleet')
 
     Parameters have same meaning as for load_route
     """
+    if store is not None:
+        _open_store(store).add(route, distance_km, speed_kmph)
+        return
     np.savez(route, distance_km=distance_km, speed_kmph=speed_kmph)
 
+def _route_path(route):
+    if not route.endswith(".npz"):
+        route = f"{route}.npz"
+    return route
+
+_stores = {}
+
+def _open_store(store):
+    # One RouteStore, and so one memory map, per store directory
+    if isinstance(store, RouteStore):
+        return store
+    path = os.path.abspath(store)
+    if path not in _stores:
+        _stores[path] = RouteStore(path)
+    return _stores[path]
+
+class Route:
+    """
+    Speed data for one route together with a prebuilt PCHIP
+    interpolant, so repeated queries neither reload the file nor
+    rebuild the interpolant. Example usage:
+
+      anna = Route.from_file('speed_anna.npz')
+      anna.velocity(21.4)
+      anna.time_to_destination(np.array([10, 20, 30]))
+      anna.reach(10000)
+
+    A Route can also be built directly from arrays,
+    Route(distance_km, speed_kmph), and can be passed anywhere the
+    module level functions below accept a route file name.
+    """
+    # Gauss-Legendre points per PCHIP segment for the route integrals
+    GAUSS_POINTS = 16
+
+    def __init__(self, distance_km, speed_kmph):
+        self.distance_km = np.asarray(distance_km, dtype=float)
+        self.speed_kmph = np.asarray(speed_kmph, dtype=float)
+        self.length = self.distance_km[-1]
+        instrumentation.count('route_interpolant')
+        self._interpolant = interpolate.PchipInterpolator(
+            self.distance_km, self.speed_kmph)
+        self._integrands = {
+            'time': self._time_integrand,
+            'consumption': self._consumption_integrand,
+        }
+        self._tables = {}
+        self._digest = None
+
+    @classmethod
+    def from_file(cls, route):
+        return cls(*load_route(route))
+
+    def velocity(self, x):
+        # Check input ok? min and max do not build a boolean array
+        assert np.min(x, initial=0) >= 0, 'x must be non-negative'
+        assert np.max(x, initial=0) <= self.length, 'x must be smaller than route length'
+        instrumentation.count('velocity', np.size(x))
+        return self._interpolant(x)
+
+    # The integrands write into out when it is given, as the buffered
+    # trapezoid does, so the only new array per block is the velocity
+    def _time_integrand(self, x, out=None):
+        if out is None:
+            return 1 / self.velocity(x)
+        return np.reciprocal(self.velocity(x), out=out)
+
+    def _consumption_integrand(self, x, out=None):
+        # The interpolant does not overshoot the measured speeds, which
+        # are non-negative, so the speeds need no check
+        return consumption(self.velocity(x), out, check=False)
+
+    def _cumulative_table(self, name):
+        """
+        Integral from 0 to each data point of the named integrand, built
+        on first use. The interpolant is a single cubic on every segment
+        between data points, so a Gauss-Legendre rule per segment gives
+        the segment integrals to machine precision.
+        """
+        F = self._tables.get(name)
+        if F is None:
+            with instrumentation.stage('cumulative_table'):
+                segments = gauss_legendre(self._integrands[name], self.distance_km[:-1],
+                                          self.distance_km[1:], self.GAUSS_POINTS)
+                F = self._tables[name] = np.concatenate(([0], np.cumsum(segments)))
+        return F
+
+    def _integral(self, name, x):
+        # Binary search for the segment, then quadrature over its first part
+        F = self._cumulative_table(name)
+        x = np.asarray(x, dtype=float)
+        k = np.clip(np.searchsorted(self.distance_km, x, side='right') - 1,
+                    0, self.distance_km.size - 2)
+        return F[k] + gauss_legendre(self._integrands[name], self.distance_km[k], x,
+                                     self.GAUSS_POINTS)
+
+    def _integrate(self, name, a, b):
+        """Signed integral of the named integrand from a to b."""
+        if b < a:
+            return -self._integrate(name, b, a)
+        i, j = np.searchsorted(self.distance_km, [a, b], side='right')
+        points = np.concatenate(([a], self.distance_km[i:j], [b]))
+        return np.sum(gauss_legendre(self._integrands[name], points[:-1], points[1:],
+                                     self.GAUSS_POINTS))
+
+    def _solver_integral(self, name):
+        # Use the cumulative table if it has already been built, otherwise
+        # integrate only the steps taken by the solver
+        if name in self._tables:
+            return lambda x: self._integral(name, x)
+        return IncrementalIntegral(self, name)
+
+    def _invert(self, name, target, tolerance=1e-12, max_iter=50):
+        """
+        Positions where the integral of the named integrand reaches each
+        value in the array target. The cumulative table is monotone, so a
+        binary search finds the segment of every target, and Newton
+        iterations, kept inside the segments, run on all of them at once
+        with rootfinding.newton. Targets beyond the whole route give the
+        route length and targets of at most zero the start of the route,
+        without iterating.
+        """
+        F = self._cumulative_table(name)
+        integrand = self._integrands[name]
+        target = np.asarray(target, dtype=float)
+        x = np.where(target >= F[-1], self.length, self.distance_km[0])
+        solve = (target > 0) & (target < F[-1])
+        inner = target[solve]
+        k = np.clip(np.searchsorted(F, inner, side='right') - 1,
+                    0, self.distance_km.size - 2)
+        lo = self.distance_km[k]
+        hi = self.distance_km[k + 1]
+        # Start from linear interpolation of the table
+        x0 = lo + (hi - lo) * np.clip((inner - F[k]) / (F[k + 1] - F[k]), 0, 1)
+        residual = lambda x, base, lo, target: (
+            base + gauss_legendre(integrand, lo, x, self.GAUSS_POINTS) - target)
+        x[solve] = rootfinding.newton(residual, lambda x, *args: integrand(x), x0,
+                                      tolerance, max_iter, lo, hi,
+                                      args=(F[k], lo, inner))
+        return x
+
+    def _integrate_to(self, name, x, N, chunk_size, tol, full_output, method):
+        integrand = self._integrands[name]
+        if tol is not None and N is not None:
+            raise ValueError("give either N or tol, not both")
+        if method is not None and tol is None:
+            raise ValueError(f"method {method!r} needs tol")
+        if tol is not None:
+            if method is None or method == 'kronrod':
+                value, error, evaluations = gauss_kronrod(integrand, 0, x, tol)
+            elif method == 'romberg':
+                value, error, evaluations = romberg(integrand, 0, x, tol,
+                                                    chunk_size=chunk_size)
+            else:
+                raise ValueError(f"unknown method {method!r}")
+            if full_output:
+                return value, {'error': error, 'evaluations': evaluations}
+            return value
+        if N is None:
+            return self._integral(name, x)
+        return trapezoid(integrand, 0, x, N, chunk_size, buffered=True)
+
+    def time_to_destination(self, x, N=None, chunk_size=65536, tol=None,
+                            full_output=False, method=None):
+        with instrumentation.stage('time_to_destination'):
+            return self._integrate_to('time', x, N, chunk_size, tol, full_output,
+                                      method)
+
+    def total_consumption(self, x, N=None, chunk_size=65536, tol=None,
+                          full_output=False, method=None):
+        with instrumentation.stage('total_consumption'):
+            return self._integrate_to('consumption', x, N, chunk_size, tol,
+                                      full_output, method)
+
+    @property
+    def digest(self):
+        """sha256 hash of the route arrays, identifying the route's data."""
+        if self._digest is None:
+            self._digest = ResultCache.key(self.distance_km, self.speed_kmph)
+        return self._digest
+
+    def _cached(self, name, value, solve):
+        # Look the solve up in the result cache, if one is enabled
+        if _result_cache is None:
+            with instrumentation.stage(name):
+                return solve(value)
+        key = _result_cache.key(name, self.digest, np.asarray(value, dtype=float),
+                                __version__)
+        result = _result_cache.get(key)
+        if result is None:
+            instrumentation.count('result_cache_misses')
+            with instrumentation.stage(name):
+                result = solve(value)
+            _result_cache.put(key, result)
+        else:
+            instrumentation.count('result_cache_hits')
+        return result
+
+    def convergence_study(self, x, n0=16, levels=22, quantity='time',
+                          chunk_size=65536):
+        """Trapezoid convergence study of time or consumption, see convergence_study."""
+        if quantity not in self._integrands:
+            raise ValueError(f"unknown quantity {quantity!r}")
+        with instrumentation.stage('convergence_study'):
+            return quadrature_convergence_study(self._integrands[quantity], 0, x, n0,
+                                                levels, chunk_size)
+
+    def distance(self, T):
+        return self._cached('distance', T, self._distance)
+
+    def reach(self, C):
+        return self._cached('reach', C, self._reach)
+
+    def _distance(self, T):
+        if np.ndim(T) > 0:
+            return self._invert('time', T)
+        time_at = self._solver_integral('time')
+        time = lambda x: time_at(x) - T
+        vel = lambda x: 1/self.velocity(x)
+        return newtons_method(time, vel, 1e-4, self.length)
+
+    def _reach(self, C):
+        if np.ndim(C) > 0:
+            return self._invert('consumption', C)
+        consumption_at = self._solver_integral('consumption')
+        tot_consump = lambda x: consumption_at(x) - C
+        return newtons_method(tot_consump, self._consumption_integrand, 1e-4,
+                              self.length)
+
+class IncrementalIntegral:
+    """
+    Integral from 0 to x of a route integrand ('time' or
+    'consumption'), where each call only integrates from the
+    previously requested x. Example usage:
+
+      time_at = IncrementalIntegral(anna, 'time')
+      time_at(30.0)   # integrates [0, 30]
+      time_at(30.2)   # integrates [30, 30.2] and adds it
+
+    Newton iterates quickly get close to each other, so the total work
+    of a solve is proportional to the distance moved by the iterates
+    rather than to the number of iterations times the route length.
+    """
+    def __init__(self, route, name):
+        self.route = route
+        self.name = name
+        self.x = 0.0
+        self.value = 0.0
+
+    def __call__(self, x):
+        self.value += self.route._integrate(self.name, self.x, x)
+        self.x = x
+        return self.value
+
+# Process wide registry of loaded routes, most recently used last
+ROUTE_CACHE_SIZE = 32
+_route_registry = OrderedDict()
+
+def get_route(route, store=None):
+    """
+    Return a Route for the given route file, reusing an already
+    loaded one if possible. Example usage:
+
+      anna = get_route('speed_anna')
+      anna = get_route('anna', store='fleet')
+
+    Up to ROUTE_CACHE_SIZE routes are kept, least recently used are
+    dropped first. A route is reloaded if its file has been modified
+    since it was loaded. Route objects are returned as they are. With
+    store, the route is taken from that RouteStore, and its arrays are
+    views into the store's memory map.
+    """
+    if isinstance(route, Route):
+        return route
+    if store is not None:
+        store = _open_store(store)
+        key = (os.path.abspath(store.path), route, tuple(store.index.get(route, ())))
+    else:
+        path = _route_path(route)
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    cached = _route_registry.get(key)
+    if cached is not None:
+        _route_registry.move_to_end(key)
+        return cached
+    loaded = Route(*load_route(route, store))
+    _route_registry[key] = loaded
+    while len(_route_registry) > ROUTE_CACHE_SIZE:
+        _route_registry.popitem(last=False)
+    return loaded
+
+def clear_route_cache():
+    """Forget all routes loaded through get_route."""
+    _route_registry.clear()
+
+_result_cache = None
+
+def enable_result_cache(directory='.roadster_cache', max_bytes=2**28):
+    """
+    Keep the results of distance and reach on disk. Example usage:
+
+      enable_result_cache('/tmp/roadster', max_bytes=2**30)
+      distance(0.5, 'speed_anna')   # solved and stored
+      distance(0.5, 'speed_anna')   # read back from disk
+
+    Results are keyed by a hash of the route arrays, the function, its
+    argument and __version__, so a changed route file or a new version
+    never gives an old result. At most max_bytes are kept, least
+    recently used results are removed first. Returns the ResultCache.
+    """
+    global _result_cache
+    _result_cache = ResultCache(directory, max_bytes)
+    return _result_cache
+
+def disable_result_cache():
+    """Solve distance and reach again every time. Stored results are kept."""
+    global _result_cache
+    _result_cache = None
+
 ### PART 1A ###
-def consumption(v):
-    assert np.all(v >= 0)
-    return 546.8 * v ** (-1) + 50.31 + 0.2594 * v + 0.008210 * v**2
+def consumption(v, out=None, check=True):
+    """
+    Energy consumption in Wh/km at speed v in km/h. Example usage:
+
+      consumption(np.array([30, 60, 90]))
+      consumption(v, out=buffer, check=False)
+
+    Evaluated as (546.8 + v*(50.31 + v*(0.2594 + 0.008210*v)))/v with
+    Horner's rule, in place in a single array. If out is given the
+    result is written into it, out must not be v itself. check=False
+    skips the test that v is non-negative, for callers that already
+    know it is.
+    """
+    if check:
+        assert np.min(v, initial=0) >= 0, 'v must be non-negative'
+    if out is None:
+        out = np.multiply(v, 0.008210)
+    else:
+        np.multiply(v, 0.008210, out=out)
+    out += 0.2594
+    out *= v
+    out += 50.31
+    out *= v
+    out += 546.8
+    out /= v
+    return out
 
 ### PART 1B ###
 def velocity(x, route):
@@ -42,49 +406,174 @@ def velocity(x, route):
     Interpolates data in given route file, and evaluates the function
     in x
     """
-    # Load data
-    distance_km, speed_kmph = load_route(route)
-    # Check input ok?
-    assert np.all(x>=0), 'x must be non-negative'
-    assert np.all(x<=distance_km[-1]), 'x must be smaller than route length'
-    # Interpolate
-    v = interpolate.pchip_interpolate(distance_km, speed_kmph, x)
-    return v
+    return get_route(route).velocity(x)
 
 ### PART 2A ###
-def time_to_destination(x, route, N):
-    h = x / (N - 1)
-    fx = 1 / velocity(np.linspace(0, x, N), route)
-    return h * (2 * np.sum(fx) - fx[-1] - fx[0]) / 2
+def time_to_destination(x, route, N=None, chunk_size=65536, tol=None,
+                        full_output=False, method=None):
+    """
+    Time (in h) to drive the first x km of the route, using the
+    trapezoidal rule with N points, evaluated chunk_size points at a
+    time to bound memory use. Without N the time is computed
+    exactly (to rounding) from the route's cumulative table of
+    per-segment Gauss-Legendre integrals, and x may then be an array.
+
+    With tol, adaptive Gauss-Kronrod quadrature is used instead, to an
+    estimated absolute error of at most tol. method='romberg' instead
+    extrapolates trapezoid values on nested grids, reusing all earlier
+    velocity evaluations when the grid is refined. full_output=True
+    then also returns a dict with the estimated 'error' and the number
+    of 'evaluations' of the velocity. Giving both N and tol, or method
+    without tol, raises ValueError.
+    """
+    return get_route(route).time_to_destination(x, N, chunk_size, tol,
+                                                full_output, method)
 
 ### PART 2B ###
-def total_consumption(x, route, N):
-    h = x / (N - 1)
-    fx = consumption(velocity(np.linspace(0, x, N), route))
-    return h * (2 * np.sum(fx) - fx[-1] - fx[0]) / 2
+def total_consumption(x, route, N=None, chunk_size=65536, tol=None,
+                      full_output=False, method=None):
+    """
+    Energy (in Wh) used for the first x km of the route, see
+    time_to_destination for the meaning of the other parameters.
+    """
+    return get_route(route).total_consumption(x, N, chunk_size, tol,
+                                              full_output, method)
+
+def newtons_method(fx, fx_prime, tolerance, x_max, max_evaluations=100,
+                   full_output=False):
+    """
+    Solve fx(x) = 0 for x in [0, x_max], where fx is increasing, with
+    Newton's method safeguarded by bisection. Example usage:
+
+      x = newtons_method(lambda x: x**2 - 2, lambda x: 2*x, 1e-10, 2)
 
-def newtons_method(fx, fx_prime, tolerance, x_max):
-    max_iter = 100
+    Every evaluation of fx narrows a bracket [lo, hi] around the root.
+    Newton steps that would leave the bracket, or that are not at least
+    twice as short as the step before, are replaced by bisection, so
+    the iteration always converges. If fx(x_max) <= 0 the
+    root lies beyond x_max and x_max is returned. At most
+    max_evaluations calls of fx are made. Iteration stops when a step
+    is shorter than tolerance.
+
+    With full_output=True, (x, info) is returned, where info is a dict
+    with the number of 'iterations' (one evaluation of fx each), the
+    'residuals' fx(x) of all iterates and whether it 'converged'.
+    """
+    lo, hi = 0.0, x_max
+    hi_evaluated = False
     x = x_max/2
-    for _ in range(max_iter):
-        dx = fx(x)/fx_prime(x)
-        x -= dx 
-        
-        if np.abs(dx) <= tolerance:
+    dx = x_max
+    residuals = []
+    converged = False
+    while len(residuals) < max_evaluations:
+        f = fx(x)
+        residuals.append(f)
+        if f == 0 or (f < 0 and x == x_max):
+            converged = True
             break
+        if f < 0:
+            lo = x
+        else:
+            hi = x
+            hi_evaluated = True
 
-        if x > x_max:
-            return x_max
+        x_new = x - f/fx_prime(x)
+        if not lo < x_new < hi:
+            # Check x_max itself before bisecting, the root may lie beyond it
+            x_new = (lo + hi)/2 if hi_evaluated else x_max
+        elif np.abs(x_new - x) > np.abs(dx)/2:
+            x_new = (lo + hi)/2
+        dx = x_new - x
+        x = x_new
+        if np.abs(dx) <= tolerance:
+            converged = True
+            break
+    instrumentation.count('newton_iterations', len(residuals))
+    if full_output:
+        info = {'iterations': len(residuals), 'residuals': residuals,
+                'converged': converged}
+        return x, info
     return x
 
+def convergence_study(x, route, n0=16, levels=22, quantity='time', chunk_size=65536):
+    """
+    How the trapezoidal rule for time_to_destination(x, route, N), or
+    total_consumption with quantity='consumption', converges as the
+    number of intervals doubles. Example usage:
+
+      study = convergence_study(65.0, 'speed_anna', n0=16, levels=22)
+      plt.loglog(study['n'], study['error'])
+
+    The grids n0, 2 n0, 4 n0, ... intervals are nested, so each level
+    only evaluates the integrand at the midpoints of the previous one,
+    and no more than chunk_size points are held at a time. Returns the
+    dict of quadrature.convergence_study, with per level 'n', 'value',
+    the error estimate 'error' = |T(n) - T(n/2)|/3, the observed
+    'order' and the number of 'evaluations'.
+    """
+    return get_route(route).convergence_study(x, n0, levels, quantity, chunk_size)
+
 ### PART 3A ###
 def distance(T, route):
-    time = lambda x: time_to_destination(x, route, 10000001) - T
-    vel = lambda x: 1/velocity(x, route)
-    return newtons_method(time, vel, 1e-4, load_route(route)[0][-1])
+    """
+    Distance (in km) driven along the route in T hours. T may be an
+    array, in which case all targets are solved together.
+    """
+    return get_route(route).distance(T)
 
 ### PART 3B ###
 def reach(C, route):
-    tot_consump = lambda x: total_consumption(x, route, 10000001) - C
-    consump = lambda x: consumption(velocity(x, route))
-    return newtons_method(tot_consump, consump, 1e-4, load_route(route)[0][-1])
\ No newline at end of file
+    """
+    Distance (in km) that can be driven along the route on a charge of
+    C Wh, capped at the route length. C may be an array, as for distance.
+    """
+    return get_route(route).reach(C)
+
+
+### MANY ROUTES ###
+def _evaluate_route(route, x, T, C, store):
+    # One row of the evaluate_routes table, run in a worker process
+    r = get_route(route, store)
+    end = r.length if x is None else min(x, r.length)
+    row = [route, r.length, r.time_to_destination(end), r.total_consumption(end)]
+    if T is not None:
+        row.append(r.distance(T))
+    if C is not None:
+        row.append(r.reach(C))
+    return row
+
+def evaluate_routes(routes, x=None, T=None, C=None, store=None, workers=None):
+    """
+    Evaluate many routes in parallel. Example usage:
+
+      table = evaluate_routes(['speed_anna', 'speed_elsa'], C=10000)
+      table = evaluate_routes(names, T=0.5, store='fleet', workers=8)
+
+    For every route the time and the energy needed to drive x km (by
+    default the whole route) are computed, and the distance driven in
+    T hours and the reach with C Wh if those are given. The routes are
+    split over a pool of worker processes (workers, by default one per
+    CPU). Only route names are sent to the workers, which read the
+    route files themselves, or map the store, so no route data is
+    pickled. workers=1 evaluates the routes in this process instead.
+
+    Returns the result table as a dict of arrays, with columns 'route',
+    'length', 'time' and 'consumption', and 'distance' and 'reach' if
+    T and C are given.
+    """
+    if isinstance(store, RouteStore):
+        store = store.path
+    columns = ['route', 'length', 'time', 'consumption']
+    columns += ['distance'] * (T is not None) + ['reach'] * (C is not None)
+    n = len(routes)
+    if n == 0:
+        return {column: np.array([]) for column in columns}
+    workers = workers or os.cpu_count()
+    args = ([x]*n, [T]*n, [C]*n, [store]*n)
+    if workers == 1:
+        rows = list(map(_evaluate_route, routes, *args))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            chunksize = max(1, n // (4*workers))
+            rows = list(executor.map(_evaluate_route, routes, *args, chunksize=chunksize))
+    return {column: np.array(values) for column, values in zip(columns, zip(*rows))}
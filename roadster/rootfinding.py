@@ -0,0 +1,114 @@
+import numpy as np
+
+import instrumentation
+
+def _flat(value, shape):
+    return np.broadcast_to(np.asarray(value, dtype=float), shape).ravel()
+
+def _result(x, shape, iterations, converged, evaluations, full_output):
+    x = x.reshape(shape)[()]
+    if full_output:
+        return x, {'iterations': iterations.reshape(shape),
+                   'converged': converged.reshape(shape), 'evaluations': evaluations}
+    return x
+
+def newton(f, fprime, x0, tol=1e-12, max_iter=50, lo=None, hi=None, args=(),
+           full_output=False):
+    """
+    Newton-Raphson iteration for many independent equations f(x) = 0
+    at once, one per element of the array of starting guesses x0.
+    Example usage:
+
+      f = lambda x: x*x - 4*np.sin(x) - 1
+      fprime = lambda x: 2*x - 4*np.cos(x)
+      x = newton(f, fprime, np.linspace(-5, 5, 101))
+
+      # One equation x**2 = p per parameter p
+      x = newton(lambda x, p: x*x - p, lambda x, p: 2*x, 1, args=(p,))
+
+    f and fprime are called with the elements that have not yet
+    converged, followed by the matching elements of each array in args
+    (broadcast together with x0). An element has converged when its
+    last step was at most tol, and is not iterated further. If lo or hi
+    are given, every iterate is clipped to [lo, hi].
+
+    With full_output=True, (x, info) is returned, where info is a dict
+    with the number of 'iterations' and whether it 'converged' for
+    every element, and the total number of 'evaluations' of f.
+    """
+    shape = np.broadcast_shapes(np.shape(x0), np.shape(lo), np.shape(hi),
+                                *(np.shape(arg) for arg in args))
+    x = _flat(x0, shape).copy()
+    args = [_flat(arg, shape) for arg in args]
+    lo = None if lo is None else _flat(lo, shape)
+    hi = None if hi is None else _flat(hi, shape)
+    iterations = np.zeros(x.size, dtype=int)
+    converged = np.zeros(x.size, dtype=bool)
+    evaluations = 0
+    active = np.arange(x.size)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        xa = x[active]
+        active_args = [arg[active] for arg in args]
+        step = f(xa, *active_args) / fprime(xa, *active_args)
+        xa -= step
+        if lo is not None:
+            np.maximum(xa, lo[active], out=xa)
+        if hi is not None:
+            np.minimum(xa, hi[active], out=xa)
+        x[active] = xa
+        iterations[active] += 1
+        evaluations += active.size
+        # One iteration per element, as counted for scalar solves
+        instrumentation.count('newton_iterations', active.size)
+        done = np.abs(step) <= tol
+        converged[active[done]] = True
+        active = active[~done]
+    return _result(x, shape, iterations, converged, evaluations, full_output)
+
+def bisection(f, a, b, tol=1e-12, max_iter=200, args=(), full_output=False):
+    """
+    Bisection for many independent equations f(x) = 0 at once, one per
+    element of the arrays of bracket ends a and b. Example usage:
+
+      x = bisection(lambda x: x*x - 4*np.sin(x) - 1, [-1, 1], [0, 3])
+
+    f must change sign between a and b. f is called as for newton. The
+    midpoint of the bracket is returned, and an element has converged
+    when that is within tol of the root or f is exactly zero at it.
+    Elements with no sign change are nan and not converged. full_output
+    is as for newton.
+    """
+    shape = np.broadcast_shapes(np.shape(a), np.shape(b),
+                                *(np.shape(arg) for arg in args))
+    a = _flat(a, shape).copy()
+    b = _flat(b, shape).copy()
+    args = [_flat(arg, shape) for arg in args]
+    fa = f(a, *args)
+    fb = f(b, *args)
+    evaluations = 2*a.size
+    iterations = np.zeros(a.size, dtype=int)
+    converged = np.zeros(a.size, dtype=bool)
+    x = (a + b)/2
+    x[np.sign(fa) == np.sign(fb)] = np.nan
+    active = np.flatnonzero(np.sign(fa) != np.sign(fb))
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        xa = (a[active] + b[active])/2
+        fx = f(xa, *[arg[active] for arg in args])
+        iterations[active] += 1
+        evaluations += active.size
+        # Bracket halvings summed over all elements still bisecting
+        instrumentation.count('bisection_iterations', active.size)
+        left = np.sign(fx) == np.sign(fa[active])
+        a[active[left]] = xa[left]
+        fa[active[left]] = fx[left]
+        b[active[~left]] = xa[~left]
+        half_width = (b[active] - a[active])/2
+        x[active] = np.where(fx == 0, xa, a[active] + half_width)
+        done = (fx == 0) | (half_width <= tol)
+        converged[active[done]] = True
+        active = active[~done]
+    return _result(x, shape, iterations, converged, evaluations, full_output)
@@ -1,5 +1,10 @@
+import math
+from functools import lru_cache
+
 import numpy as np 
-from pchip_2d import pchip_2d
+from pchip_2d import Pchip2D
+import instrumentation
+import roadster
 
 N_data_t = 25
 data_t = np.linspace(0, 24, N_data_t)
@@ -22,56 +27,323 @@ def route_nyc(t,x):
     Returns:
       Speed in km/h    
     """
-    return pchip_2d(data_t,data_x,nyc_velocity,t,x)-10
+    if instrumentation.recording():
+        instrumentation.count('route_nyc', np.broadcast(t, x).size)
+    return nyc_interpolant()(t,x)-10
+
+def route_nyc_scalar(t,x):
+    """
+    Same as route_nyc(t, x)[0][0] for a single time t and position x,
+    but evaluated with plain Python floats, which is much faster when
+    called once per time step.
+    """
+    instrumentation.count('route_nyc_scalar')
+    return nyc_interpolant().scalar(float(t),float(x))-10
+
+@lru_cache(maxsize=None)
+def nyc_interpolant():
+    """
+    Interpolant of nyc_velocity, built on first use. Equivalent to
+    pchip_2d(data_t, data_x, nyc_velocity, t, x), but with the bicubic
+    coefficients of all cells precomputed.
+    """
+    return Pchip2D(data_t, data_x, nyc_velocity)
 
 ### PART 4A ###
-def nyc_route_traveler_euler(t0, h): # With np.array
-    time_h = np.arange(t0, 24, h)
-    distance_km = np.zeros(len(time_h))
-    speed_kmph = np.zeros(len(time_h))
+def nyc_route_traveler_euler(t0, h):
+    with instrumentation.stage('nyc_route_traveler_euler'):
+        time_h, distance_km, speed_kmph = zip(*nyc_route_traveler_euler_states(t0, h))
+    return np.array(time_h), np.array(distance_km), np.array(speed_kmph)
+
+def nyc_route_traveler_euler_states(t0, h):
+    """
+    Generator version of nyc_route_traveler_euler, yielding the state
+    (t, x, v) of every step as it is computed. Example usage:
 
-    distance_km[0] = 0
-    speed_kmph[0] = route_nyc(t=t0, x=0)[0][0] # Returns a weird np.array with one entery
+      for t, x, v in nyc_route_traveler_euler_states(8, 0.01):
+          ...
+      t, x, v = final_state(nyc_route_traveler_euler_states(8, 0.01))
 
-    index = 0
-    for i, t in enumerate(time_h[1:]):
-        i += 1
-        n_distance_km = h*speed_kmph[i-1] + distance_km[i-1]
-        if n_distance_km > 60: break
+    The steps are taken at the times np.arange(t0, 24, h), and the last
+    state is where the trip reaches 60 km, extrapolated linearly from
+    the last step. This may be just after the last of those times.
+    Raises ValueError if the trip does not get that far.
+    """
+    # Times are computed exactly as np.arange(t0, 24, h) computes them
+    steps = math.ceil((24 - t0)/h)
+    delta = (t0 + h) - t0
+    t, x = t0, 0
+    v = route_nyc_scalar(t0, 0)
+    yield t, x, v
+    for i in range(1, steps + 1):
+        n_distance_km = h*v + x
+        if n_distance_km > 60:
+            t_end = t + (60 - x)/v
+            yield t_end, 60, route_nyc_scalar(t_end, 60)
+            return
+        if i == steps:
+            break
+        t = t0 + h if i == 1 else t0 + i*delta
+        x = n_distance_km
+        v = route_nyc_scalar(t, x)
+        yield t, x, v
+    raise ValueError(f"departure at {t0} h does not reach the end of the route before midnight")
+
+def final_state(states):
+    """
+    Last state from a generator of states, such as
+    nyc_route_traveler_euler_states or nyc_route_states, keeping only
+    one state in memory at a time.
+    """
+    for state in states:
+        pass
+    return state
+
+def nyc_route_traveler_euler_batch(t0, h, energy=False):
+    """
+    Arrival times (hour of day) at the end of the route for departures
+    at all the times in the array t0, simulated in lockstep with
+    Euler's method with step h. Example usage:
+
+      arrival_h = nyc_route_traveler_euler_batch(np.arange(0, 22, 1/60), 0.01)
+      arrival_h, energy_Wh = nyc_route_traveler_euler_batch(t0, 0.01, energy=True)
+
+    Each step evaluates route_nyc once for all vehicles still on the
+    route. The arrival times are the same as time_h[-1] from
+    nyc_route_traveler_euler for each departure. Departures that do not
+    reach the end of the route before midnight get nan.
+
+    With energy=True the energy used on each trip (in Wh) is returned
+    as well, integrating roadster.consumption(v) over the distance
+    along with the trajectory: every step adds the consumption at the
+    speed at its start times the distance driven in the step.
+    """
+    t0 = np.asarray(t0, dtype=float)
+    arrival_h = np.full(t0.size, np.nan)
+    energy_Wh = np.full(t0.size, np.nan)
+    start = t0.ravel()
+    # Times are computed as np.arange(t0, 24, h) does in the single traveler
+    steps = np.ceil((24 - start)/h)
+    delta = (start + h) - start
+    active = np.arange(start.size)
+    time_h = start.copy()
+    distance_km = np.zeros(start.size)
+    speed_kmph = route_nyc(start, distance_km)[0]
+    used_Wh = np.zeros(start.size)
+    step = 0
+    while active.size:
+        step += 1
+        n_distance_km = h*speed_kmph + distance_km
+        arrived = n_distance_km > 60
+        arrival_h[active[arrived]] = (time_h[arrived] +
+                                      (60 - distance_km[arrived])/speed_kmph[arrived])
+        if energy:
+            used_Wh += roadster.consumption(speed_kmph)*(np.minimum(n_distance_km, 60) - distance_km)
+            energy_Wh[active[arrived]] = used_Wh[arrived]
+        # Keep driving while there are step times left before midnight
+        driving = ~arrived & (step < steps[active])
+        active = active[driving]
+        used_Wh = used_Wh[driving]
+        distance_km = n_distance_km[driving]
+        if step == 1:
+            time_h = start[active] + h
+        else:
+            time_h = start[active] + step*delta[active]
+        speed_kmph = route_nyc(time_h, distance_km)[0]
+    if energy:
+        return arrival_h.reshape(t0.shape), energy_Wh.reshape(t0.shape)
+    return arrival_h.reshape(t0.shape)
 
-        distance_km[i] = n_distance_km
-        speed_kmph[i] = route_nyc(t, n_distance_km)[0][0]
-        index = i
+### PART 4B ###
+def _euler_step(f, t, x, v, h):
+    return x + h*v
 
-    t_diff = (60 - distance_km[index]) / speed_kmph[index]
+def _heun_step(f, t, x, v, h):
+    k2 = f(t + h, x + h*v)
+    return x + 0.5*h*(v + k2)
 
-    distance_km[index + 1] = (60)
-    time_h[index + 1] = time_h[index] + t_diff
-    speed_kmph[index + 1] = (route_nyc(time_h[index + 1], 60)[0][0])
+def _rk4_step(f, t, x, v, h):
+    k2 = f(t + 0.5*h, x + 0.5*h*v)
+    k3 = f(t + 0.5*h, x + 0.5*h*k2)
+    k4 = f(t + h, x + h*k3)
+    return x + h/6*(v + 2*k2 + 2*k3 + k4)
 
-    return time_h[:index + 2], distance_km[:index + 2], speed_kmph[:index + 2]
+_FIXED_STEP = {'euler': _euler_step, 'heun': _heun_step, 'rk4': _rk4_step}
 
-#def nyc_route_traveler_euler(t0, h): # With lists
-    time_h = [t0]
-    distance_km = [0]
-    speed_kmph = [route_nyc(t0, 0)[0][0]]
+# Dormand-Prince 5(4) pair
+_DOPRI_C = (1/5, 3/10, 4/5, 8/9, 1, 1)
+_DOPRI_A = ((1/5,),
+            (3/40, 9/40),
+            (44/45, -56/15, 32/9),
+            (19372/6561, -25360/2187, 64448/6561, -212/729),
+            (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+            (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84))
+_DOPRI_E = (71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40)
 
-    while time_h[-1] <= 24:
-      t = time_h[-1] + h
-      n_distance_km = h*speed_kmph[-1] + distance_km[-1]
-      if n_distance_km > 60: break
+def _dopri5(f, t, x, v, h):
+    # One step, returns the new position and speed and the error estimate
+    k = [v]
+    for c, a in zip(_DOPRI_C, _DOPRI_A):
+        k.append(f(t + c*h, x + h*sum(ai*ki for ai, ki in zip(a, k))))
+    # The last stage is evaluated at the new point (first same as last)
+    x_new = x + h*sum(ai*ki for ai, ki in zip(_DOPRI_A[-1], k))
+    return x_new, k[-1], abs(h*sum(ei*ki for ei, ki in zip(_DOPRI_E, k)))
 
-      distance_km.append(n_distance_km)
-      speed_kmph.append(route_nyc(t, n_distance_km)[0][0])
-      time_h.append(t)
+def _dopri5_step(f, t, x, v, h, tol):
+    # One accepted step, returns the new position and speed, the step
+    # used and the step to try next
+    while True:
+        x_new, v_new, error = _dopri5(f, t, x, v, h)
+        factor = min(5.0, max(0.2, 0.9*(tol/error)**0.2)) if error > 0 else 5.0
+        if error <= tol:
+            return x_new, v_new, h, h*factor
+        h *= factor
 
-    t_diff = 60 - distance_km[-1] / speed_kmph[-1]
+def _crossing(x, v, x_new, v_new, h, x_end):
+    # Fraction s of the step where the cubic Hermite interpolant of the
+    # step reaches x_end
+    p = lambda s: ((2*s**3 - 3*s**2 + 1)*x + (s**3 - 2*s**2 + s)*h*v +
+                   (-2*s**3 + 3*s**2)*x_new + (s**3 - s**2)*h*v_new) - x_end
+    dp = lambda s: ((6*s**2 - 6*s)*x + (3*s**2 - 4*s + 1)*h*v +
+                    (-6*s**2 + 6*s)*x_new + (3*s**2 - 2*s)*h*v_new)
+    return roadster.newtons_method(p, dp, 1e-14, 1.0)
 
-    distance_km.append(60)
-    time_h.append(time_h[-1] + t_diff)
-    speed_kmph.append(route_nyc(time_h[-1], 60)[0][0])
+def _end_of_route(f, step, t, x, v, x_new, v_new, h, x_end=60):
+    # Time where the trip reaches x_end during the step from (t, x) to
+    # (t + h, x_new). The dense output gives a first estimate, which is
+    # then corrected by Newton iterations that redo the partial step
+    # with the integrator itself, so the end is located as accurately
+    # as the rest of the trajectory.
+    s = _crossing(x, v, x_new, v_new, h, x_end)
+    for _ in range(10):
+        x_s = step(f, t, x, v, s*h)
+        ds = (x_end - x_s)/(f(t + s*h, x_s)*h)
+        s += ds
+        if abs(ds*h) <= 1e-14:
+            break
+    return t + s*h
+
+def nyc_route_states(t0, h, method='rk4', tol=1e-8):
+    """
+    Generator version of nyc_route_traveler, yielding the state
+    (t, x, v) after every step as it is computed, the last one where
+    the trip reaches 60 km. Use final_state to get only that one.
+    """
+    f = route_nyc_scalar
+    t, x = float(t0), 0.0
+    v = f(t, x)
+    yield t, x, v
+    if method == 'dopri5':
+        step = lambda f, t, x, v, h: _dopri5(f, t, x, v, h)[0]
+    elif method in _FIXED_STEP:
+        step = _FIXED_STEP[method]
+    else:
+        raise ValueError(f"unknown method {method!r}")
+    n = 0
+    while t < 24:
+        if method == 'dopri5':
+            x_new, v_new, h_used, h = _dopri5_step(f, t, x, v, h, tol)
+            t_new = t + h_used
+        else:
+            x_new = step(f, t, x, v, h)
+            h_used = h
+            n += 1
+            t_new = t0 + n*h
+            v_new = f(t_new, x_new)
+        if x_new >= 60:
+            t_end = _end_of_route(f, step, t, x, v, x_new, v_new, h_used)
+            yield t_end, 60.0, f(t_end, 60.0)
+            return
+        t, x, v = t_new, x_new, v_new
+        yield t, x, v
+    raise ValueError(f"departure at {t0} h does not reach the end of the route before midnight")
+
+def nyc_route_traveler(t0, h, method='rk4', tol=1e-8):
+    """
+    Simulates a trip along the NYC route departing at time t0, like
+    nyc_route_traveler_euler, with a choice of integrator for
+    dx/dt = route_nyc(t, x):
+
+      'euler', 'heun', 'rk4': fixed step h
+      'dopri5': adaptive Dormand-Prince 5(4) pair, starting with step h
+                and keeping the estimated error of every step below
+                tol (in km)
+
+    The last entry is the point where the trip reaches 60 km. It is
+    located with the cubic Hermite interpolant of the last step (dense
+    output), refined by redoing the partial step with the integrator,
+    rather than by extrapolating linearly. Returns time_h, distance_km
+    and speed_kmph.
+    """
+    with instrumentation.stage('nyc_route_traveler'):
+        time_h, distance_km, speed_kmph = zip(*nyc_route_states(t0, h, method, tol))
     return np.array(time_h), np.array(distance_km), np.array(speed_kmph)
 
+def trip_time(t0, h=0.01):
+    """
+    Trip time (in h) along the NYC route for departures at the times
+    in the array t0, with the batched Euler traveler and step h. inf
+    for departures that do not arrive before midnight.
+    """
+    duration_h = nyc_route_traveler_euler_batch(t0, h) - np.asarray(t0, dtype=float)
+    return np.where(np.isnan(duration_h), np.inf, duration_h)
+
+def trip_energy(t0, h=0.01):
+    """
+    Energy (in Wh) used on the NYC route for departures at the times in
+    the array t0, see trip_time.
+    """
+    _, energy_Wh = nyc_route_traveler_euler_batch(t0, h, energy=True)
+    return np.where(np.isnan(energy_Wh), np.inf, energy_Wh)
+
+def optimal_departure(objective=trip_time, t_min=0, t_max=24, n_scan=145, tol=1e-6):
+    """
+    Departure time in [t_min, t_max] that minimizes objective, by
+    default the trip time. Example usage:
+
+      t0, value, scan_t0, scan_value = optimal_departure()
+
+    objective takes an array of departure times and returns an array
+    of values, such as trip_time or trip_energy, so that all departures
+    of a round are simulated together. It is first evaluated on n_scan equally spaced departure
+    times. Every local minimum of that scan is then refined with
+    golden-section search, all at once, until the brackets are shorter
+    than tol, and the best one is returned. Returns the optimal
+    departure time, the objective value there, and the scanned
+    departure times and values as the full profile. If the objective
+    is not finite for any scanned departure, such as when no trip in
+    the window arrives before midnight, the optimal departure time is
+    nan and the value inf.
+    """
+    scan_t0 = np.linspace(t_min, t_max, n_scan)
+    scan_value = objective(scan_t0)
+    padded = np.concatenate(([np.inf], scan_value, [np.inf]))
+    minima = np.flatnonzero((scan_value <= padded[:-2]) & (scan_value <= padded[2:]) &
+                            np.isfinite(scan_value))
+    if minima.size == 0:
+        return np.nan, np.inf, scan_t0, scan_value
+    # Golden-section search on the brackets around all local minima
+    g = (np.sqrt(5) - 1)/2
+    a = scan_t0[np.maximum(minima - 1, 0)]
+    b = scan_t0[np.minimum(minima + 1, n_scan - 1)]
+    c = b - g*(b - a)
+    d = a + g*(b - a)
+    fc = objective(c)
+    fd = objective(d)
+    while np.max(b - a, initial=0) > tol:
+        left = fc < fd
+        # The minimum is in [a, d] if left, else in [c, b], and one of
+        # the interior points is reused
+        a, b = np.where(left, a, c), np.where(left, d, b)
+        new = np.where(left, b - g*(b - a), a + g*(b - a))
+        f_new = objective(new)
+        c, d, fc, fd = (np.where(left, new, d), np.where(left, c, new),
+                        np.where(left, f_new, fd), np.where(left, fc, f_new))
+    candidates = np.concatenate((scan_t0[minima], c, d))
+    values = np.concatenate((scan_value[minima], fc, fd))
+    best = np.argmin(values)
+    return candidates[best], values[best], scan_t0, scan_value
+
 if __name__ == "__main__":
   time_h , distance_km , speed_kmph = nyc_route_traveler_euler(8, 0.5)
   print(time_h[-1])
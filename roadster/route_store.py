@@ -0,0 +1,89 @@
+import json
+import os
+
+import numpy as np
+
+class RouteStore:
+    """
+    Many routes in one uncompressed file, opened with np.memmap, so
+    that loading a route gives views into the file without copying and
+    all processes reading the store share the OS page cache. Example
+    usage:
+
+      store = RouteStore('fleet')
+      store.add('anna', *roadster.load_route('speed_anna.npz'))
+      distance_km, speed_kmph = store.load('anna')
+
+    The store is a directory with two files: data.f64 holds the arrays
+    of all routes back to back as float64, and index.json gives the
+    offset and length of each route. Adding a route appends its arrays
+    and then replaces the index, so readers never see a partly written
+    route. Adding a route under an existing name replaces it in the
+    index, the old arrays stay in the data file. Only one process
+    should add routes at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data_path = os.path.join(path, 'data.f64')
+        self._index_path = os.path.join(path, 'index.json')
+        self._data = None
+        self._index = None
+        self._index_version = None
+
+    @property
+    def index(self):
+        """Offset and length of every route, reread when the store changes."""
+        try:
+            stat = os.stat(self._index_path)
+        except FileNotFoundError:
+            return {}
+        # os.replace in add gives the index a new inode, which tells
+        # rewrites apart even within one timestamp tick at the same size
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version != self._index_version:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+            self._index_version = version
+        return self._index
+
+    def names(self):
+        return list(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def load(self, name):
+        """
+        Read-only views of the distance_km and speed_kmph arrays of the
+        named route, as returned by roadster.load_route.
+        """
+        try:
+            offset, length = self.index[name]
+        except KeyError:
+            raise KeyError(f"no route {name!r} in store {self.path!r}") from None
+        if self._data is None or self._data.size < offset + 2*length:
+            # Map the file again, it has grown since it was mapped
+            self._data = np.memmap(self._data_path, dtype=np.float64, mode='r')
+        return (self._data[offset:offset + length],
+                self._data[offset + length:offset + 2*length])
+
+    def add(self, name, distance_km, speed_kmph):
+        """Append a route to the store, see roadster.save_route."""
+        distance_km = np.asarray(distance_km, dtype=np.float64)
+        speed_kmph = np.asarray(speed_kmph, dtype=np.float64)
+        assert distance_km.shape == speed_kmph.shape and distance_km.ndim == 1, \
+            'distance_km and speed_kmph must be 1D arrays of equal length'
+        os.makedirs(self.path, exist_ok=True)
+        index = dict(self.index)
+        with open(self._data_path, 'ab') as f:
+            offset = f.tell() // 8
+            f.write(distance_km.tobytes())
+            f.write(speed_kmph.tobytes())
+        index[name] = [offset, distance_km.size]
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+        stat = os.stat(self._index_path)
+        self._index = index
+        self._index_version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
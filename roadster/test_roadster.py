@@ -1,7 +1,14 @@
+import os
 import numpy as np
 import pytest
 import roadster
 import route_nyc
+import instrumentation
+import quadrature
+import result_cache
+import rootfinding
+import route_store
+from pchip_2d import pchip_2d
 
 ### PART 1A, CONSUMPTION ###
 def test_part1a_A():
@@ -242,3 +249,459 @@ def test_part4a_E():
     # check last value in speed_kmph
     ref_value_speed_m1 = 67.501135806462414735
     assert np.isclose(ref_value_speed_m1,speed_kmph[-1]), 'last value in speed_kmph vector different from reference value'
+
+### ROUTE OBJECT ###
+def test_route_A():
+    distance_km, speed_kmph = roadster.load_route('speed_anna.npz')
+    anna = roadster.Route(distance_km, speed_kmph)
+    dist_array = np.array([0,2.3,4.53])
+    assert np.all(anna.velocity(dist_array) == roadster.velocity(dist_array, 'speed_anna')), 'Route.velocity differs from velocity(...)'
+
+def test_route_B():
+    roadster.clear_route_cache()
+    assert roadster.get_route('speed_elsa') is roadster.get_route('speed_elsa.npz'), 'get_route(...) should reuse the loaded route'
+    anna = roadster.Route.from_file('speed_anna')
+    assert roadster.get_route(anna) is anna, 'get_route(...) should return Route objects as they are'
+
+### CUMULATIVE TABLES ###
+def test_table_A():
+    # Same reference value as test_part2a_C
+    ref_value   = 0.5574635291451433
+    check_value = roadster.time_to_destination(41.3, 'speed_elsa.npz')
+    assert np.isclose(ref_value, check_value), 'time_to_destination(...) without N not close to reference value'
+
+def test_table_B():
+    # Same reference values as test_part2b_B and test_part2b_C
+    distance_km, _ = roadster.load_route('speed_elsa.npz')
+    ref_array   = np.array([3146.038423676377, 8017.547481110507])
+    check_array = roadster.total_consumption(np.array([23.7, distance_km[-1]]), 'speed_elsa.npz')
+    assert np.all(np.isclose(ref_array, check_array)), 'total_consumption(...) without N not close to reference values'
+
+### GAUSS-LEGENDRE ###
+def test_gauss_A():
+    # 4 points are exact for polynomials up to degree 7
+    check_value = quadrature.gauss_legendre(lambda x: 8*x**7 - 3*x**2, 1, 2, n=4)
+    assert np.isclose((2**8 - 1) - (2**3 - 1), check_value, rtol=1e-14), 'gauss_legendre(...) not exact for polynomial'
+
+def test_gauss_B():
+    route = 'speed_anna.npz'
+    x = 35
+    ref_value   = roadster.time_to_destination(x, route, 1000001)
+    check_value = roadster.time_to_destination(x, route)
+    assert np.isclose(ref_value, check_value, rtol=1e-11), 'time_to_destination(...) without N not close to fine trapezoid value'
+
+### INCREMENTAL INTEGRAL ###
+def test_incremental_A():
+    anna = roadster.Route.from_file('speed_anna.npz')
+    time_at = roadster.IncrementalIntegral(anna, 'time')
+    for x in [30.0, 30.2, 12.7, 12.7, 51.3]:
+        check_value = time_at(x)
+    ref_value = anna.time_to_destination(51.3)
+    assert np.isclose(ref_value, check_value, rtol=1e-12), 'IncrementalIntegral(...) not close to table value'
+
+def test_incremental_B():
+    # Same reference value as test_part3a_A, without building the table
+    anna = roadster.Route.from_file('speed_anna.npz')
+    check_value = anna.distance(0.5)
+    assert not anna._tables, 'distance(...) should not build the cumulative table'
+    assert isclose(51.07040584543483, check_value), 'distance(...) not close to reference value'
+
+### BATCH DISTANCE AND REACH ###
+def test_batch_A():
+    # Same reference values as test_part3a_A and test_part3a_B
+    check_array = np.array([roadster.distance(np.array([0.5]), 'speed_anna.npz')[0],
+                            roadster.distance(np.array([0.3]), 'speed_elsa.npz')[0]])
+    ref_array   = np.array([51.07040584543483, 21.712201790750854])
+    assert np.all(isclose(ref_array, check_array)), 'distance(array, ...) not close to reference values'
+
+def test_batch_B():
+    # Same reference values as test_part3b_A and test_part3b_D
+    route = 'speed_anna.npz'
+    distance_km, _ = roadster.load_route(route)
+    check_array = roadster.reach(np.array([10000, 20000, 0]), route)
+    ref_array   = np.array([52.72227475296071, distance_km[-1], 0])
+    assert np.all(isclose(ref_array, check_array)), 'reach(array, ...) not close to reference values'
+
+def test_batch_C():
+    # Targets outside the route are answered without Newton iterations
+    route = 'speed_anna.npz'
+    distance_km, _ = roadster.load_route(route)
+    roadster.reach(np.array([10000]), route)
+    with instrumentation.record() as recorder:
+        check_array = roadster.reach(np.array([-5, 0, 10000, 20000, 1e9]), route)
+    ref_array = np.array([0, 0, 52.72227475296071, distance_km[-1], distance_km[-1]])
+    assert np.all(isclose(ref_array, check_array)), 'reach(array, ...) not close to reference values'
+    assert recorder.calls['newton_iterations'] < 10, 'targets outside the route kept Newton iterating'
+
+### SAFEGUARDED NEWTON ###
+def test_newton_A():
+    # Newton from x_max/2 would jump below 0 here
+    fx = lambda x: np.arctan(x - 1)
+    fx_prime = lambda x: 1/(1 + (x - 1)**2)
+    x, info = roadster.newtons_method(fx, fx_prime, 1e-12, 40, full_output=True)
+    assert np.isclose(1, x), 'newtons_method(...) did not find the root'
+    assert info['converged'] and info['iterations'] == len(info['residuals'])
+
+def test_newton_B():
+    # Root beyond x_max, and a budget of evaluations
+    x, info = roadster.newtons_method(lambda x: x - 50, lambda x: 1, 1e-12, 40, full_output=True)
+    assert x == 40, 'newtons_method(...) should return x_max when the root lies beyond it'
+    _, info = roadster.newtons_method(np.tanh, lambda x: 1, 1e-12, 3, max_evaluations=3, full_output=True)
+    assert info['iterations'] == 3 and not info['converged']
+
+### CHUNKED TRAPEZOID ###
+def test_chunked_A():
+    # Same reference value as test_part2a_B, with blocks not dividing N
+    ref_value   = 0.4049811174885838
+    check_value = roadster.time_to_destination(35, 'speed_anna.npz', 101, chunk_size=7)
+    assert np.isclose(ref_value, check_value), 'time_to_destination(...) with chunks not close to reference value'
+
+def test_chunked_B():
+    # Same reference value as test_part2b_A, one point per block
+    ref_value   = 2346.23132202919
+    check_value = roadster.total_consumption(15.4, 'speed_anna.npz', 3, chunk_size=1)
+    assert np.isclose(ref_value, check_value), 'total_consumption(...) with chunks not close to reference value'
+
+### ADAPTIVE QUADRATURE ###
+def test_adaptive_A():
+    value, error, evaluations = quadrature.gauss_kronrod(lambda x: 1/(1 + x**2), 0, 10, 1e-10)
+    assert np.isclose(np.arctan(10), value, rtol=0, atol=1e-10), 'gauss_kronrod(...) not close to arctan(10)'
+    assert error <= 1e-10 and evaluations % 15 == 0
+
+def test_adaptive_B():
+    # Same reference value as test_part2b_B
+    ref_value   = 3146.038423676377
+    check_value, info = roadster.total_consumption(23.7, 'speed_elsa.npz', tol=1e-6, full_output=True)
+    assert np.isclose(ref_value, check_value), 'total_consumption(...) with tol not close to reference value'
+    assert info['error'] <= 1e-6
+
+### ROMBERG ###
+def test_romberg_A():
+    value, error, evaluations = quadrature.romberg(np.exp, 0, 1, 1e-12)
+    assert np.isclose(np.e - 1, value, rtol=0, atol=1e-12), 'romberg(...) not close to e - 1'
+    # Nested grids with 1, 2, 4, ... intervals reuse all points
+    n = evaluations - 1
+    assert n & (n - 1) == 0, 'romberg(...) should evaluate f once per grid point'
+
+def test_romberg_B():
+    # Same reference value as test_part2a_C
+    ref_value   = 0.5574635291451433
+    check_value = roadster.time_to_destination(41.3, 'speed_elsa.npz', tol=1e-8, method='romberg')
+    assert np.isclose(ref_value, check_value, rtol=0, atol=1e-8), 'time_to_destination(...) with romberg not close to reference value'
+
+def test_romberg_C():
+    # method only applies with tol, and tol and N exclude each other
+    with pytest.raises(ValueError):
+        roadster.time_to_destination(30, 'speed_anna.npz', method='romberg')
+    with pytest.raises(ValueError):
+        roadster.total_consumption(30, 'speed_anna.npz', 1001, tol=1e-6)
+    with pytest.raises(ValueError):
+        roadster.time_to_destination(30, 'speed_anna.npz', tol=1e-6, method='simpson')
+
+### PCHIP 2D ###
+def test_pchip_2d_A():
+    # The interpolant goes through the data, also for the last row and column
+    tt, xx = np.meshgrid(route_nyc.data_t, route_nyc.data_x)
+    check_array = pchip_2d(route_nyc.data_t, route_nyc.data_x, route_nyc.nyc_velocity, tt, xx)
+    assert np.allclose(route_nyc.nyc_velocity, check_array, rtol=1e-14), 'pchip_2d(...) does not reproduce the data'
+
+def test_pchip_2d_B():
+    t = np.array([[0.3, 5.5, 23.9]])
+    x = np.array([[59.2, 0.1, 31.0]])
+    check_array = pchip_2d(route_nyc.data_t, route_nyc.data_x, route_nyc.nyc_velocity, t, x)
+    for i in range(3):
+        ref_value = pchip_2d(route_nyc.data_t, route_nyc.data_x, route_nyc.nyc_velocity, t[0, i], x[0, i])
+        assert check_array.shape == (1, 3) and ref_value.shape == (1, 1)
+        assert check_array[0, i] == ref_value[0, 0], 'pchip_2d(...) differs between array and scalar input'
+
+def test_pchip_2d_C():
+    t = np.array([[0, 3.3, 24], [12.5, 17.01, 8]])
+    x = np.array([[0, 7.7, 60], [33.3, 59.99, 0.5]])
+    ref_array   = pchip_2d(route_nyc.data_t, route_nyc.data_x, route_nyc.nyc_velocity, t, x)
+    check_array = route_nyc.nyc_interpolant()(t, x)
+    assert np.allclose(ref_array, check_array, rtol=1e-13), 'Pchip2D(...) not close to pchip_2d(...)'
+
+def test_pchip_2d_D():
+    for t, x in [(0, 0), (24, 60), (6.7, 12.3), (23.99, 0.01), (9.5, 37.5)]:
+        ref_value   = route_nyc.route_nyc(t, x)[0][0]
+        check_value = route_nyc.route_nyc_scalar(t, x)
+        assert type(check_value) is float
+        assert np.isclose(ref_value, check_value, rtol=1e-13), 'route_nyc_scalar(...) not close to route_nyc(...)'
+
+### BATCHED NYC ROUTE TRAVELER ###
+def test_batch_euler_A():
+    t0 = np.array([8, 12.34, 4, 9.5])
+    h  = 0.5
+    check_array = route_nyc.nyc_route_traveler_euler_batch(t0, h)
+    ref_array   = np.array([route_nyc.nyc_route_traveler_euler(t, h)[0][-1] for t in t0])
+    assert np.all(ref_array == check_array), 'nyc_route_traveler_euler_batch(...) differs from nyc_route_traveler_euler(...)'
+
+def test_batch_euler_B():
+    # Same reference value as test_part4a_E
+    check_array = route_nyc.nyc_route_traveler_euler_batch(np.array([[12.34], [23.9]]), 0.01)
+    assert check_array.shape == (2, 1)
+    assert np.isclose(13.742324071473458247, check_array[0, 0]), 'nyc_route_traveler_euler_batch(...) not close to reference value'
+    assert np.isnan(check_array[1, 0]), 'departures not arriving before midnight should give nan'
+
+### PART 4B, NYC ROUTE TRAVELER RK ###
+def test_part4b_A():
+    t0 = 8
+    # ref_value computed with RK4 and h = 1e-4
+    ref_value = 9.76820994668869
+    for method, h, atol in [('euler', 0.001, 1e-3), ('heun', 0.01, 1e-3), ('rk4', 0.01, 1e-5),
+                            ('dopri5', 0.1, 1e-8)]:
+        time_h, distance_km, speed_kmph = route_nyc.nyc_route_traveler(t0, h, method, tol=1e-10)
+        assert time_h[0] == t0 and distance_km[0] == 0 and distance_km[-1] == 60
+        assert np.isclose(ref_value, time_h[-1], rtol=0, atol=atol), f'nyc_route_traveler(..., {method!r}) not close to reference value'
+
+def test_part4b_B():
+    time_h, distance_km, speed_kmph = route_nyc.nyc_route_traveler(8, 0.5, 'rk4')
+    assert time_h.size == distance_km.size == speed_kmph.size
+    assert np.all(np.diff(time_h) > 0) and np.all(distance_km[:-1] < 60)
+    assert np.isclose(route_nyc.route_nyc_scalar(time_h[-1], 60), speed_kmph[-1])
+    with pytest.raises(ValueError):
+        route_nyc.nyc_route_traveler(23.5, 0.1)
+
+### STREAMING NYC ROUTE TRAVELER ###
+def test_states_A():
+    # Same reference values as test_part4a_D
+    t, x, v = route_nyc.final_state(route_nyc.nyc_route_traveler_euler_states(8, 0.5))
+    assert np.isclose(10.003611662684603445, t) and x == 60, 'final_state(...) not close to reference value'
+    assert np.isclose(34.824801684943381019, v), 'final_state(...) not close to reference value'
+
+def test_states_B():
+    # The trip ends after the last of the times np.arange(22.5, 24, 0.5)
+    t0 = 22.5
+    h  = 0.5
+    time_h, distance_km, speed_kmph = route_nyc.nyc_route_traveler_euler(t0, h)
+    assert time_h.size == np.arange(t0, 24, h).size + 1 and distance_km[-1] == 60
+    assert time_h[-1] == route_nyc.nyc_route_traveler_euler_batch(np.array([t0]), h)[0]
+    with pytest.raises(ValueError):
+        route_nyc.nyc_route_traveler_euler(23.9, 0.01)
+
+### DEPARTURE TIME ###
+def test_departure_A():
+    # Two local minima, the global one at t = 17
+    objective = lambda t: np.minimum((t - 5)**2 + 1, 0.5*(t - 17)**2)
+    t0, value, scan_t0, scan_value = route_nyc.optimal_departure(objective, tol=1e-8)
+    assert np.isclose(17, t0, atol=1e-6) and np.isclose(0, value, atol=1e-10), 'optimal_departure(...) did not find the global minimum'
+    assert scan_t0.size == scan_value.size
+
+def test_departure_B():
+    t0, value, scan_t0, scan_value = route_nyc.optimal_departure(n_scan=49)
+    assert value <= np.min(scan_value)
+    assert np.isclose(value, route_nyc.trip_time(np.array([t0]))[0])
+    assert np.isinf(scan_value[-1]), 'departures at midnight cannot arrive'
+
+def test_departure_C():
+    # No departure in the window arrives before midnight
+    t0, value, scan_t0, scan_value = route_nyc.optimal_departure(t_min=23.2, t_max=24, n_scan=9)
+    assert np.isnan(t0) and np.isinf(value), 'optimal_departure(...) without arrivals not nan, inf'
+    assert np.all(np.isinf(scan_value))
+
+### NYC ROUTE ENERGY ###
+def test_nyc_energy_A():
+    t0 = np.array([8, 12.34])
+    h  = 0.01
+    arrival_h, energy_Wh = route_nyc.nyc_route_traveler_euler_batch(t0, h, energy=True)
+    assert np.all(arrival_h == route_nyc.nyc_route_traveler_euler_batch(t0, h))
+    for i in range(t0.size):
+        time_h, distance_km, speed_kmph = route_nyc.nyc_route_traveler_euler(t0[i], h)
+        ref_value = np.sum(roadster.consumption(speed_kmph[:-1])*np.diff(distance_km))
+        assert np.isclose(ref_value, energy_Wh[i]), 'energy along the trajectory not close to reference value'
+
+def test_nyc_energy_B():
+    check_array = route_nyc.trip_energy(np.array([3, 23.9]), 0.1)
+    assert np.isfinite(check_array[0]) and np.isinf(check_array[1])
+
+### ROUTE STORE ###
+def test_store_A(tmp_path):
+    store = str(tmp_path / 'fleet')
+    for name in ['anna', 'elsa']:
+        roadster.save_route(name, *roadster.load_route(f'speed_{name}.npz'), store=store)
+    distance_km, speed_kmph = roadster.load_route('elsa', store=store)
+    assert isinstance(distance_km.base, np.memmap) or isinstance(distance_km, np.memmap)
+    assert np.all(distance_km == roadster.load_route('speed_elsa.npz')[0])
+    # Same reference value as test_part1b_A
+    assert np.isclose(103.58230081237032, roadster.get_route('anna', store=store).velocity(21.4))
+
+def test_store_B(tmp_path):
+    store = route_store.RouteStore(str(tmp_path / 'fleet'))
+    store.add('olof', [0, 1, 2], [10, 20, 30])
+    first = roadster.get_route('olof', store=store)
+    assert roadster.get_route('olof', store=store) is first
+    store.add('olof', [0, 2, 4], [10, 20, 30])
+    assert store.names() == ['olof'] and roadster.get_route('olof', store=store).length == 4, 'replaced route not reloaded'
+    with pytest.raises(KeyError):
+        store.load('anna')
+
+def test_store_C(tmp_path):
+    # A rewrite of the index of the same size within one timestamp tick,
+    # as on filesystems with coarse timestamps, is still noticed
+    path = str(tmp_path / 'fleet')
+    writer = route_store.RouteStore(path)
+    reader = route_store.RouteStore(path)
+    writer.add('olof', [0, 1, 2], [10, 20, 30])
+    assert reader.index == {'olof': [0, 3]}
+    stat = os.stat(writer._index_path)
+    writer.add('olof', [0, 2, 4], [10, 20, 30])
+    os.utime(writer._index_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert writer.index == reader.index == {'olof': [6, 3]}, 'rewritten index not reread'
+    assert roadster.get_route('olof', store=reader).length == 4
+
+### MANY ROUTES ###
+def test_evaluate_routes_A():
+    routes = ['speed_anna.npz', 'speed_elsa.npz', 'speed_anna.npz']
+    table = roadster.evaluate_routes(routes, T=0.5, C=10000, workers=2)
+    assert list(table) == ['route', 'length', 'time', 'consumption', 'distance', 'reach']
+    assert list(table['route']) == routes
+    # Same reference values as test_part3a_A, test_part3b_A and test_part3b_C
+    assert isclose(51.07040584543483, table['distance'][0])
+    assert np.all(isclose(np.array([52.72227475296071, 65.00405, 52.72227475296071]), table['reach']))
+
+def test_evaluate_routes_B(tmp_path):
+    store = str(tmp_path / 'fleet')
+    roadster.save_route('elsa', *roadster.load_route('speed_elsa.npz'), store=store)
+    table = roadster.evaluate_routes(['elsa'], x=41.3, store=store, workers=1)
+    # Same reference value as test_part2a_C
+    assert np.isclose(0.5574635291451433, table['time'][0])
+
+### IN-PLACE BUFFERS ###
+def test_buffers_A():
+    # Same reference array as test_part1a_C, written into a given array
+    v = np.array([0.1,23.7,48.53,201.3])
+    ref_array = np.array([5518.3360221 ,   84.14098486,   93.50181036,  437.92663867])
+    out = np.empty(4)
+    result = roadster.consumption(v, out=out, check=False)
+    assert result is out, 'consumption(..., out=out) did not return out'
+    assert np.all(np.isclose(out, ref_array)), 'consumption(..., out=out) not close to reference array'
+    with pytest.raises(AssertionError):
+        roadster.consumption(np.array([10.0, -1.0]))
+
+def test_buffers_B():
+    # Same reference value as test_part2a_B, the integrand writes into
+    # the block buffers of the trapezoid
+    route = roadster.get_route('speed_anna.npz')
+    out = np.empty(3)
+    result = route._time_integrand(np.array([0,2.3,4.53]), out)
+    assert result is out, 'time integrand did not return out'
+    assert np.all(np.isclose(out, 1/np.array([5.0,51.20013042688889,78.3714678653808])))
+    check_value = roadster.time_to_destination(35, 'speed_anna.npz', 101, chunk_size=7)
+    assert np.isclose(0.4049811174885838, check_value), 'time_to_destination(...) with buffers not close to reference value'
+    assert roadster.velocity(np.array([]), 'speed_anna.npz').size == 0
+
+def test_buffers_C():
+    f = lambda x, out: np.sin(x, out=out)
+    check_value = quadrature.trapezoid(f, 0, np.pi, 1001, chunk_size=7, buffered=True)
+    assert check_value == quadrature.trapezoid(np.sin, 0, np.pi, 1001, chunk_size=7), \
+        'buffered trapezoid differs from unbuffered trapezoid'
+
+### RESULT CACHE ###
+def test_result_cache_A(tmp_path):
+    cache = roadster.enable_result_cache(str(tmp_path / 'cache'))
+    try:
+        # Same reference value as test_part3a_A, solved once then read back
+        ref_value = 51.07040584543483
+        first = roadster.distance(0.5, 'speed_anna.npz')
+        second = roadster.distance(0.5, 'speed_anna.npz')
+        assert (cache.misses, cache.hits) == (1, 1), 'second distance(...) not read from cache'
+        assert isclose(ref_value, second), 'cached distance(...) not close to reference value'
+        assert first == second, 'cached distance(...) differs from solved distance'
+        T = np.array([0.5, 0.3])
+        assert np.array_equal(roadster.distance(T, 'speed_anna.npz'),
+                              roadster.distance(T, 'speed_anna.npz'))
+    finally:
+        roadster.disable_result_cache()
+
+def test_result_cache_B(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path), max_bytes=400)
+    for i in range(5):
+        cache.put(cache.key('x', i), np.zeros(10))
+    assert cache.get(cache.key('x', 0)) is None, 'least recently used result not evicted'
+    assert np.array_equal(cache.get(cache.key('x', 4)), np.zeros(10))
+    # Over budget, the least recently used results were removed down to
+    # three quarters of max_bytes
+    assert sum(f.stat().st_size for f in tmp_path.glob('*.npy')) <= 300
+    # A changed route has a new hash, so its old results are not found
+    d, s = roadster.load_route('speed_anna.npz')
+    assert roadster.Route(d, s).digest != roadster.Route(d, s + 1).digest
+
+def test_result_cache_C(tmp_path, monkeypatch):
+    cache = result_cache.ResultCache(str(tmp_path), max_bytes=2**20)
+    scans = []
+    scandir = result_cache.os.scandir
+    monkeypatch.setattr(result_cache.os, 'scandir', lambda path: scans.append(path) or scandir(path))
+    for i in range(20):
+        cache.put(cache.key('x', i), np.zeros(10))
+    assert scans == [], 'put under budget scanned the cache directory'
+    cache.max_bytes = 1000
+    cache.put(cache.key('x', 20), np.zeros(10))
+    assert len(scans) == 1 and sum(f.stat().st_size for f in tmp_path.glob('*.npy')) <= 750
+
+### INSTRUMENTATION ###
+def test_instrumentation_A():
+    roadster.clear_route_cache()
+    with instrumentation.record() as recorder:
+        roadster.reach(10000, 'speed_anna.npz')
+        roadster.reach(10000, 'speed_anna.npz')
+    report = recorder.to_dict()
+    assert report['counts']['load_route'] == 1, 'route loaded more than once'
+    assert report['counts']['route_interpolant'] == 1, 'interpolant built more than once'
+    assert report['calls']['newton_iterations'] == 2
+    assert report['counts']['velocity'] > report['calls']['velocity'] > 0
+    assert report['stages']['reach']['calls'] == 2
+    # Batch solves count iterations per solved element, not per round
+    counts = []
+    for C in (np.array([10000]), np.array([10000, 10000])):
+        with instrumentation.record() as recorder:
+            roadster.reach(C, 'speed_anna.npz')
+        counts.append(recorder.counts['newton_iterations'])
+    assert counts[1] == 2*counts[0], 'batch Newton iterations not counted per element'
+
+def test_instrumentation_B():
+    with instrumentation.record() as outer:
+        with instrumentation.record() as inner:
+            route_nyc.route_nyc(np.linspace(0, 24, 5), 30)
+        route_nyc.route_nyc_scalar(8, 30)
+    assert inner.to_dict()['counts'] == {'route_nyc': 5}
+    assert outer.to_dict()['counts'] == {'route_nyc_scalar': 1}
+    assert not instrumentation.recording()
+
+### CONVERGENCE STUDY ###
+def test_convergence_A():
+    study = quadrature.convergence_study(np.sin, 0, np.pi, n0=16, levels=8)
+    assert np.all(study['n'] == 16 * 2**np.arange(8))
+    assert study['evaluations'][-1] == study['n'][-1] + 1, 'grid points evaluated more than once'
+    assert np.all(np.isclose(study['order'][2:], 2, atol=1e-2)), 'observed order of trapezoid not 2'
+    assert np.isnan(study['error'][0]) and np.isnan(study['order'][1])
+
+def test_convergence_B():
+    # The finest level equals the trapezoid rule with as many points
+    study = roadster.convergence_study(35, 'speed_anna.npz', n0=25, levels=4)
+    check_value = roadster.time_to_destination(35, 'speed_anna.npz', study['n'][-1] + 1)
+    assert np.isclose(study['value'][-1], check_value), 'convergence_study value not close to trapezoid value'
+    assert np.isclose(study['error'][-1], abs(study['value'][-1] - study['value'][-2])/3)
+    with pytest.raises(ValueError):
+        roadster.convergence_study(35, 'speed_anna.npz', quantity='speed')
+
+### ROOT FINDING ###
+def test_rootfinding_A():
+    # The equation of the Newton and bisection demos in labs/L3
+    f = lambda x: x*x - 4*np.sin(x) - 1
+    fprime = lambda x: 2*x - 4*np.cos(x)
+    roots = np.array([-0.2380728993, 2.1068670794])
+    x, info = rootfinding.newton(f, fprime, np.array([-1.0, 3.0]), full_output=True)
+    assert np.allclose(x, roots), 'newton(...) not close to roots'
+    assert np.all(info['converged']) and np.all(info['iterations'] < 10)
+    x, info = rootfinding.bisection(f, [-1, 1, 5], [0, 3, 6], tol=1e-12, full_output=True)
+    assert np.allclose(x[:2], roots), 'bisection(...) not close to roots'
+    assert np.isnan(x[2]) and not info['converged'][2], 'bracket without sign change not flagged'
+
+def test_rootfinding_B():
+    # One equation per parameter, elements converge and stop separately
+    p = np.array([1.0, 2.0, 1e6])
+    x, info = rootfinding.newton(lambda x, p: x*x - p, lambda x, p: 2*x, 1.0, args=(p,),
+                                 full_output=True)
+    assert np.allclose(x, np.sqrt(p)), 'newton(...) with args not close to square roots'
+    assert info['iterations'][0] < info['iterations'][2]
+    assert info['evaluations'] == np.sum(info['iterations'])